@@ -5,8 +5,27 @@ class SepsisAdmissionCohort(BQCohort):
 	Class to get the sepsis admission cohort from OMOP schema.
 	Note: Optional, can specify pre-existing admission rollup in labeler arguments.
 	'''
-	def __init__(self, *args, **kwargs):
-		BQCohort.__init__(self, *args, **kwargs)
+	def __init__(self, *args, db=None, **kwargs):
+		if db is None:
+			BQCohort.__init__(self, *args, **kwargs)
+		else:
+			# BQCohort.__init__ only builds the config and a client, so a shared client skips it
+			self.config_dict = self.get_config_dict(**kwargs)
+			self.db = db
+	
+	def get_table_options_str(self):
+		if not self.config_dict.get("partition_tables"):
+			return ""
+		return "PARTITION BY DATETIME_TRUNC(admit_date, {}) CLUSTER BY person_id".format(
+			self.config_dict.get("partition_granularity", "MONTH")
+		)
+	
+	def get_order_by_str(self):
+		# BigQuery rejects a top-level ORDER BY when the created table is partitioned or clustered
+		return "" if self.config_dict.get("partition_tables") else "ORDER BY person_id, row_number"
+	
+	def get_output_tables(self):
+		return [self.config_dict['admission_rollup']]
 	
 	def get_base_query(self, format_query=True):
 		query = """ (
@@ -15,7 +34,11 @@ class SepsisAdmissionCohort(BQCohort):
 				t1.person_id, 
 				visit_concept_id, 
 				visit_start_datetime, 
-				visit_end_datetime
+				visit_end_datetime,
+				t2.birth_DATETIME,
+				t2.gender_concept_id,
+				t2.race_concept_id,
+				t2.ethnicity_concept_id
 			FROM {dataset_project}.{dataset}.visit_occurrence t1
 			INNER JOIN {dataset_project}.{dataset}.person as t2
 				ON t1.person_id = t2.person_id
@@ -141,7 +164,82 @@ class SepsisAdmissionCohort(BQCohort):
 				LEFT JOIN ethnicity_name en on en.person_id = t1.person_id
 				LEFT JOIN `{dataset_project}.{dataset}.person` AS person on person.person_id = t1.person_id
 			),
-			pred_id_result AS (
+			{prediction_id_query}
+		"""
+
+		if not format_query:
+			return query
+		else:
+			return query.format_map(
+				{**self.config_dict, **{"base_query": self.get_base_query(), "prediction_id_query": self.get_prediction_id_query()}}
+			)
+
+	def get_merged_transform_query(self, format_query=True):
+		'''
+		Rolls visits up into admissions in a single ordered pass: a visit starts a new admission when it starts after 
+		the running max of the end times of the earlier visits of the person, so overlapping and touching visits are merged.
+		Demographics are carried through the base query, so person is read once, together with visit_occurrence.
+		'''
+		query = """
+			WITH visits AS (
+			  SELECT *
+			  FROM {base_query}
+			),
+			visits_running_end AS (
+			  SELECT *, 
+				  MAX(visit_end_datetime) OVER(
+					  PARTITION BY person_id ORDER BY visit_start_datetime, visit_end_datetime 
+					  ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+				  ) AS previous_end_datetime
+			  FROM visits
+			),
+			visits_numbered AS (
+			  SELECT *, 
+				  COUNTIF(previous_end_datetime IS NULL OR visit_start_datetime > previous_end_datetime) OVER(
+					  PARTITION BY person_id ORDER BY visit_start_datetime, visit_end_datetime 
+					  ROWS UNBOUNDED PRECEDING
+				  ) AS row_number
+			  FROM visits_running_end
+			),
+			admissions AS (
+				SELECT person_id, row_number, 
+				MIN(visit_start_datetime) AS admit_date, 
+				MAX(visit_end_datetime) AS discharge_date, 
+				ANY_VALUE(birth_DATETIME) AS birth_DATETIME, 
+				ANY_VALUE(gender_concept_id) AS gender_concept_id, 
+				ANY_VALUE(race_concept_id) AS race_concept_id, 
+				ANY_VALUE(ethnicity_concept_id) AS ethnicity_concept_id
+				FROM visits_numbered
+				GROUP BY person_id, row_number
+			),
+			result AS (
+				SELECT t1.person_id, admit_date, discharge_date, t1.birth_DATETIME, gender.concept_name AS gender_name, race.concept_name AS race_name, ethnicity.concept_name AS ethnicity_name, 
+				DATE_DIFF(CAST(admit_date AS DATE), CAST(t1.birth_DATETIME AS DATE), YEAR) AS age_in_years,
+				CASE 
+					WHEN DATE_DIFF(CAST(admit_date AS DATE), CAST(t1.birth_DATETIME AS DATE), YEAR) <= 18 THEN 0
+					ELSE 1 
+				END adult_at_admission,
+				t1.row_number
+				FROM admissions t1
+				LEFT JOIN `{dataset_project}.{dataset}.concept` AS gender ON t1.gender_concept_id = gender.concept_id
+				LEFT JOIN `{dataset_project}.{dataset}.concept` AS race ON t1.race_concept_id = race.concept_id
+				LEFT JOIN `{dataset_project}.{dataset}.concept` AS ethnicity ON t1.ethnicity_concept_id = ethnicity.concept_id
+			),
+			{prediction_id_query}
+		"""
+
+		if not format_query:
+			return query
+		else:
+			return query.format_map(
+				{**self.config_dict, **{"base_query": self.get_base_query(), "prediction_id_query": self.get_prediction_id_query()}}
+			)
+
+	def get_prediction_id_query(self):
+		'''
+		Keeps one admission per person and assigns it a prediction_id.
+		'''
+		query = """pred_id_result AS (
 				SELECT * EXCEPT (rnd, pos), 
 				FARM_FINGERPRINT(GENERATE_UUID()) as prediction_id
 				FROM (
@@ -158,20 +256,14 @@ class SepsisAdmissionCohort(BQCohort):
 			)
 			SELECT * EXCEPT (row_number)
 			FROM pred_id_result
-			ORDER BY person_id, row_number
+			{order_by_str}
 		"""
-
-		if not format_query:
-			return query
-		else:
-			return query.format_map(
-				{**self.config_dict, **{"base_query": self.get_base_query()}}
-			)
+		return query.format_map({"order_by_str": self.get_order_by_str()})
 
 	def get_create_query(self, format_query=True):
 
 		query = """ 
-			CREATE OR REPLACE TABLE {admission_rollup} AS
+			CREATE OR REPLACE TABLE {admission_rollup} {table_options_str} AS
 			{query}
 		"""
 
@@ -179,7 +271,8 @@ class SepsisAdmissionCohort(BQCohort):
 			pass
 		else:
 			query = query.format_map(
-				{**self.config_dict, **{"query": self.get_transform_query()}}
+				{**self.config_dict, **{"query": self.get_merged_transform_query() if self.config_dict.get("fast_admission_rollup") else self.get_transform_query(), 
+										"table_options_str": self.get_table_options_str()}}
 			)
 		
 		if self.config_dict['print_query']:
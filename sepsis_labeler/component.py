@@ -6,12 +6,24 @@ class SuspectedInfectionComponent(Component):
 	'''
 	Class to get suspected infections in cohort.
 	'''
+	table_key = 'suspected_infection'
+	measurement_analytes = {'blood_culture_from_measurement_via_ancestor': 'blood_culture'}
+	drug_exposures = {'systemic_abx_from_drug_exposure_with_name': ('systemic_abx', 'systemic_abx_type')}
+	
 	def __init__(self, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
+	
+	def get_input_tables(self):
+		tables = [self.config_dict['admission_rollup']]
+		if self.config_dict['use_measurement_extract']:
+			tables.append(self.config_dict['sepsis_measurement'])
+		if self.config_dict['use_drug_extract']:
+			tables.append(self.config_dict['sepsis_drug'])
+		return tables
 		
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{suspected_infection}` AS
+				CREATE OR REPLACE TABLE `{suspected_infection}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -28,7 +40,10 @@ class SuspectedInfectionComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
-		query = '''
+		if self.config_dict['use_measurement_extract']:
+			blood_culture_query = self.get_measurement_extract_query(format_query=False)
+		else:
+			blood_culture_query = '''
 				WITH 
 				blood_culture_list AS (
 					SELECT 
@@ -45,6 +60,11 @@ class SuspectedInfectionComponent(Component):
 						SELECT concept_id
 						FROM blood_culture_list)
 				),
+				'''
+		if self.config_dict['use_drug_extract']:
+			systemic_abx_query = self.get_drug_extract_query(format_query=False, leading_with=False)
+		else:
+			systemic_abx_query = '''
 				systemic_abx_list AS (
 					SELECT 
 						descendant_concept_id AS concept_id
@@ -69,6 +89,11 @@ class SuspectedInfectionComponent(Component):
 					INNER JOIN {dataset_project}.{dataset}.concept AS concept
 					ON systemic_abx.drug_concept_id = concept.concept_id
 				),
+				'''
+		if self.config_dict['bounded_infection_join']:
+			pair_query = self.get_bounded_pair_query(format_query=False)
+		else:
+			pair_query = '''
 				bc_abx AS (
 					SELECT 
 						blood_culture.person_id, 
@@ -89,6 +114,8 @@ class SuspectedInfectionComponent(Component):
 					LEFT JOIN bc_abx AS bc_abx
 					ON admission_rollup.person_id = bc_abx.person_id
 				),
+				'''
+		query = blood_culture_query + systemic_abx_query + pair_query + '''
 				admit_age AS (
 					SELECT
 						admit_bc_abx.*,
@@ -102,6 +129,47 @@ class SuspectedInfectionComponent(Component):
 		else:
 			return query.format_map(self.config_dict)
 
+	def get_bounded_pair_query(self, format_query=True):
+		'''
+		Pairs each blood culture only with the antibiotics started from the day before to three days after it, 
+		and each pair only with the admissions whose days it falls on, which are the pairs susp_inf_window keeps.
+		Every blood culture is expanded to the five candidate antibiotic days and joined on (person_id, day), 
+		so the intermediate rows grow with the number of events instead of their per-person cross product.
+		'''
+		query = '''
+				bc_abx AS (
+					SELECT 
+						blood_culture.person_id, 
+						blood_culture.measurement_DATETIME as bc_DATETIME,
+						systemic_abx.drug_exposure_start_DATETIME, 
+						systemic_abx.systemic_abx_type
+					FROM blood_culture_from_measurement_via_ancestor AS blood_culture
+					CROSS JOIN UNNEST(GENERATE_DATE_ARRAY(
+						DATE_SUB(CAST(blood_culture.measurement_DATETIME AS DATE), INTERVAL 1 DAY), 
+						DATE_ADD(CAST(blood_culture.measurement_DATETIME AS DATE), INTERVAL 3 DAY)
+					)) AS abx_date
+					INNER JOIN systemic_abx_from_drug_exposure_with_name AS systemic_abx
+					ON blood_culture.person_id = systemic_abx.person_id 
+					AND abx_date = CAST(systemic_abx.drug_exposure_start_DATETIME AS DATE)
+				),
+				admit_bc_abx AS (
+					SELECT 
+						admission_rollup.*, 
+						bc_abx.bc_DATETIME, 
+						bc_abx.drug_exposure_start_DATETIME, 
+						bc_abx.systemic_abx_type   
+					FROM `{admission_rollup}` as admission_rollup
+					INNER JOIN bc_abx AS bc_abx
+					ON admission_rollup.person_id = bc_abx.person_id
+					AND CAST(bc_abx.bc_DATETIME AS DATE) 
+						BETWEEN DATE_SUB(CAST(admission_rollup.admit_date AS DATE), INTERVAL 1 DAY) AND CAST(admission_rollup.discharge_date AS DATE)
+				),
+				'''
+		if not format_query:
+			return query
+		else:
+			return query.format_map(self.config_dict)
+
 	def get_window_query(self, format_query=True):
 		query = '''
 				susp_inf_window AS (
@@ -159,13 +227,19 @@ class PlateletComponent(Component):
 	Class to get platelet count for cohort.
 	Units are 1000/uL
 	'''
+	table_key = 'sepsis_platelet'
+	values_ctes = ['platelet_from_measurement']
+	rollup_cte = 'platelet_rollup'
+	measurement_analytes = {'platelet_from_measurement': 'platelet'}
+	daily_aggregate = 'min'
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_platelet}` AS
+				CREATE OR REPLACE TABLE `{sepsis_platelet}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -178,7 +252,8 @@ class PlateletComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_platelet":self.config_dict['sepsis_platelet'] + '_prior' if self.prior else self.config_dict['sepsis_platelet']})
+							"sepsis_platelet":self.config_dict['sepsis_platelet'] + '_prior' if self.prior else self.config_dict['sepsis_platelet'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -186,6 +261,10 @@ class PlateletComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_daily_aggregates']:
+			return self.get_daily_aggregate_query(format_query)
+		if self.config_dict['use_measurement_extract']:
+			return self.get_measurement_extract_query(format_query)
 		query = '''
 				WITH platelet_from_measurement AS (
 					SELECT 
@@ -257,13 +336,19 @@ class CreatinineComponent(Component):
 	Class to get creatinine measurement for cohort.
 	Units are normalized to mg/dL
 	'''
+	table_key = 'sepsis_creatinine'
+	values_ctes = ['creatinine_from_measurement']
+	rollup_cte = 'creatinine_rollup'
+	measurement_analytes = {'creatinine_from_measurement': 'creatinine'}
+	daily_aggregate = 'max'
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_creatinine}` AS
+				CREATE OR REPLACE TABLE `{sepsis_creatinine}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -276,7 +361,8 @@ class CreatinineComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_creatinine":self.config_dict['sepsis_creatinine'] + '_prior' if self.prior else self.config_dict['sepsis_creatinine']})
+							"sepsis_creatinine":self.config_dict['sepsis_creatinine'] + '_prior' if self.prior else self.config_dict['sepsis_creatinine'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -284,6 +370,10 @@ class CreatinineComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_daily_aggregates']:
+			return self.get_daily_aggregate_query(format_query)
+		if self.config_dict['use_measurement_extract']:
+			return self.get_measurement_extract_query(format_query)
 		query = '''
 				WITH creatinine_from_measurement AS (
 					SELECT 
@@ -358,13 +448,19 @@ class GlasgowComaScaleComponent(Component):
 	'''
 	Class to get glasgow coma scale score measurement for cohort.
 	'''
+	table_key = 'sepsis_gcs'
+	values_ctes = ['gcs_from_measurement']
+	rollup_cte = 'gcs_rollup'
+	measurement_analytes = {'gcs_from_measurement': 'gcs'}
+	daily_aggregate = 'min'
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_gcs}` AS
+				CREATE OR REPLACE TABLE `{sepsis_gcs}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -377,7 +473,8 @@ class GlasgowComaScaleComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_gcs":self.config_dict['sepsis_gcs'] + '_prior' if self.prior else self.config_dict['sepsis_gcs']})
+							"sepsis_gcs":self.config_dict['sepsis_gcs'] + '_prior' if self.prior else self.config_dict['sepsis_gcs'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -385,6 +482,10 @@ class GlasgowComaScaleComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_daily_aggregates']:
+			return self.get_daily_aggregate_query(format_query)
+		if self.config_dict['use_measurement_extract']:
+			return self.get_measurement_extract_query(format_query)
 		query = '''
 				WITH gcs_from_measurement AS (
 					SELECT 
@@ -443,13 +544,19 @@ class BilirubinComponent(Component):
 	Class to get bilirubin measurement for cohort.
 	Units are normalized to mg/dL
 	'''
+	table_key = 'sepsis_bilirubin'
+	values_ctes = ['bilirubin_from_measurement']
+	rollup_cte = 'bilirubin_rollup'
+	measurement_analytes = {'bilirubin_from_measurement': 'bilirubin'}
+	daily_aggregate = 'max'
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_bilirubin}` AS
+				CREATE OR REPLACE TABLE `{sepsis_bilirubin}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -462,7 +569,8 @@ class BilirubinComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_bilirubin":self.config_dict['sepsis_bilirubin'] + '_prior' if self.prior else self.config_dict['sepsis_bilirubin']})
+							"sepsis_bilirubin":self.config_dict['sepsis_bilirubin'] + '_prior' if self.prior else self.config_dict['sepsis_bilirubin'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -470,6 +578,10 @@ class BilirubinComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_daily_aggregates']:
+			return self.get_daily_aggregate_query(format_query)
+		if self.config_dict['use_measurement_extract']:
+			return self.get_measurement_extract_query(format_query)
 		query = '''
 				WITH bilirubin_from_measurement AS (
 					SELECT 
@@ -540,13 +652,20 @@ class MechanicalVentilationComponent(Component):
 	'''
 	Class to get mechanical ventilation measurement for cohort.
 	'''
+	table_key = 'sepsis_vent'
+	reads_flowsheet = True
+	flowsheet_display_names = ['VENT MODE', 'VENTILATION MODE']
+	values_ctes = ['mech_vent_from_flowsheet']
+	rollup_cte = 'mech_vent_rollup'
+	respiratory_measures = {'mech_vent_from_flowsheet': ('vent_mode', 'value_as_string', 'meas_value')}
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_vent}` AS
+				CREATE OR REPLACE TABLE `{sepsis_vent}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -559,7 +678,8 @@ class MechanicalVentilationComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_vent":self.config_dict['sepsis_vent'] + '_prior' if self.prior else self.config_dict['sepsis_vent']})
+							"sepsis_vent":self.config_dict['sepsis_vent'] + '_prior' if self.prior else self.config_dict['sepsis_vent'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -567,6 +687,8 @@ class MechanicalVentilationComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_respiratory_extract']:
+			return self.get_respiratory_extract_query(format_query)
 		query = '''
 				WITH mech_vent_from_flowsheet AS (
 					SELECT 
@@ -626,13 +748,19 @@ class LactateComponent(Component):
 	Class to get lactate measurement for cohort.
 	Units are normalized to mmol/L
 	'''
+	table_key = 'sepsis_lactate'
+	values_ctes = ['lactate_from_measurement']
+	rollup_cte = 'lactate_rollup'
+	measurement_analytes = {'lactate_from_measurement': 'lactate'}
+	daily_aggregate = 'max'
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_lactate}` AS
+				CREATE OR REPLACE TABLE `{sepsis_lactate}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -645,7 +773,8 @@ class LactateComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_lactate":self.config_dict['sepsis_lactate'] + '_prior' if self.prior else self.config_dict['sepsis_lactate']})
+							"sepsis_lactate":self.config_dict['sepsis_lactate'] + '_prior' if self.prior else self.config_dict['sepsis_lactate'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -653,6 +782,10 @@ class LactateComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_daily_aggregates']:
+			return self.get_daily_aggregate_query(format_query)
+		if self.config_dict['use_measurement_extract']:
+			return self.get_measurement_extract_query(format_query)
 		query = '''
 				WITH lactate_from_measurement AS (
 					SELECT 
@@ -727,13 +860,21 @@ class PaO2FiO2Component(Component):
 	'''
 	Class to get PaO2:FiO2 ratio measurement for cohort.
 	'''
+	table_key = 'sepsis_pao2_fio2'
+	reads_flowsheet = True
+	flowsheet_display_names = ['FIO2 (%)', 'FIO2 %']
+	values_ctes = ['paO2_from_measurement', 'fiO2_from_flowsheet']
+	rollup_cte = 'paO2_fiO2_rollup'
+	measurement_analytes = {'paO2_from_measurement': 'pao2'}
+	respiratory_measures = {'fiO2_from_flowsheet': ('fio2', 'value_as_number', 'fiO2')}
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_pao2_fio2}` AS
+				CREATE OR REPLACE TABLE `{sepsis_pao2_fio2}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -746,7 +887,8 @@ class PaO2FiO2Component(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_pao2_fio2":self.config_dict['sepsis_pao2_fio2'] + '_prior' if self.prior else self.config_dict['sepsis_pao2_fio2']})
+							"sepsis_pao2_fio2":self.config_dict['sepsis_pao2_fio2'] + '_prior' if self.prior else self.config_dict['sepsis_pao2_fio2'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -754,7 +896,10 @@ class PaO2FiO2Component(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
-		query = '''
+		if self.config_dict['use_measurement_extract']:
+			paO2_query = self.get_measurement_extract_query(format_query=False)
+		else:
+			paO2_query = '''
 				WITH paO2_from_measurement AS (
 					SELECT 
 						measure.person_id, 
@@ -766,6 +911,11 @@ class PaO2FiO2Component(Component):
 					ON measure.measurement_concept_id = concept.concept_id
 					WHERE concept.concept_id=3027801 AND value_as_number IS NOT NULL
 				),
+				'''
+		if self.config_dict['use_respiratory_extract']:
+			fiO2_query = self.get_respiratory_extract_query(format_query=False, leading_with=False)
+		else:
+			fiO2_query = '''
 				fiO2_vals as (
 					SELECT 
 						person_id, 
@@ -790,6 +940,7 @@ class PaO2FiO2Component(Component):
 					from fiO2_vals
 				),
 				'''
+		query = paO2_query + fiO2_query
 		if not format_query:
 			return query
 		else:
@@ -826,6 +977,23 @@ class PaO2FiO2Component(Component):
 					{obs_window} AND
 					fiO2 >=0.21 AND fiO2 <=1.0
 				),
+				{pairing_query}
+				'''
+		if not format_query:
+			return query
+		else:
+			return query.format_map(
+					{
+						**self.config_dict,
+						**{"meas_window":self.config_dict['meas_window_prior'] if self.prior else self.config_dict['meas_window'],
+						   "obs_window":self.config_dict['obs_window_prior'] if self.prior else self.config_dict['obs_window'],
+						   "pairing_query":self.get_pairing_query()}
+					})
+
+	def get_pairing_query(self, format_query=True):
+		if self.config_dict['asof_fio2_join']:
+			return self.get_fio2_asof_query('paO2', format_query)
+		query = '''
 				paO2_fiO2_window AS (
 					SELECT 
 						paO2_window.person_id, 
@@ -846,14 +1014,11 @@ class PaO2FiO2Component(Component):
 		if not format_query:
 			return query
 		else:
-			return query.format_map(
-					{
-						**self.config_dict,
-						**{"meas_window":self.config_dict['meas_window_prior'] if self.prior else self.config_dict['meas_window'],
-						   "obs_window":self.config_dict['obs_window_prior'] if self.prior else self.config_dict['obs_window']}
-					})
+			return query.format_map(self.config_dict)
 
 	def get_rollup_query(self, format_query=True):
+		if self.config_dict['asof_fio2_join']:
+			return self.get_fio2_asof_rollup_query('paO2', format_query)
 		query = '''
 				paO2_fiO2_initial_rollup AS (
 					SELECT 
@@ -895,13 +1060,23 @@ class SpO2FiO2Component(Component):
 	'''
 	Class to get SpO2:FiO2 measurement ratio for cohort.
 	'''
+	table_key = 'sepsis_spo2_fio2'
+	reads_flowsheet = True
+	flowsheet_display_names = ['OXYGEN SATURATION', 'SPO2 - %', 'FIO2 (%)', 'FIO2 %']
+	values_ctes = ['spO2_from_flowsheet', 'fiO2_from_flowsheet']
+	rollup_cte = 'spO2_fiO2_rollup'
+	respiratory_measures = {
+		'spO2_from_flowsheet': ('spo2', 'value_as_number', 'meas_value'),
+		'fiO2_from_flowsheet': ('fio2', 'value_as_number', 'fiO2'),
+	}
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_spo2_fio2}` AS
+				CREATE OR REPLACE TABLE `{sepsis_spo2_fio2}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -914,7 +1089,8 @@ class SpO2FiO2Component(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_spo2_fio2":self.config_dict['sepsis_spo2_fio2'] + '_prior' if self.prior else self.config_dict['sepsis_spo2_fio2']})
+							"sepsis_spo2_fio2":self.config_dict['sepsis_spo2_fio2'] + '_prior' if self.prior else self.config_dict['sepsis_spo2_fio2'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -922,6 +1098,8 @@ class SpO2FiO2Component(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_respiratory_extract']:
+			return self.get_respiratory_extract_query(format_query)
 		query = '''
 				WITH spO2_from_flowsheet AS (
 					SELECT 
@@ -1000,6 +1178,21 @@ class SpO2FiO2Component(Component):
 					{window} AND
 					fiO2 >=0.21 AND fiO2 <=1.0
 				),
+				{pairing_query}
+				'''
+		if not format_query:
+			return query
+		else:
+			return query.format_map({
+				**self.config_dict,
+				**{"window":self.config_dict['obs_window_prior'] if self.prior else self.config_dict['obs_window'],
+				   "pairing_query":self.get_pairing_query()}
+			})
+
+	def get_pairing_query(self, format_query=True):
+		if self.config_dict['asof_fio2_join']:
+			return self.get_fio2_asof_query('spO2', format_query)
+		query = '''
 				spO2_fiO2_window AS (
 					SELECT 
 						spO2_window.person_id, 
@@ -1020,9 +1213,11 @@ class SpO2FiO2Component(Component):
 		if not format_query:
 			return query
 		else:
-			return query.format_map({**self.config_dict,**{"window":self.config_dict['obs_window_prior'] if self.prior else self.config_dict['obs_window']}})
+			return query.format_map(self.config_dict)
 
 	def get_rollup_query(self, format_query=True):
+		if self.config_dict['asof_fio2_join']:
+			return self.get_fio2_asof_rollup_query('spO2', format_query)
 		query = '''
 				spO2_fiO2_initial_rollup AS (
 					SELECT 
@@ -1068,13 +1263,18 @@ class DopamineComponent(Component):
 	Class to get dopamine drug exposure for cohort.
 	Dosage amounts are unavailable in STARR-OMOP, so only the presence of the drug exposure will be used.
 	'''
+	table_key = 'sepsis_dopamine'
+	values_ctes = ['dopamine_from_drug_exposure_with_name']
+	drug_exposures = {'dopamine_from_drug_exposure_with_name': ('dopamine', 'dopamine_type')}
+	rollup_cte = 'dopamine_rollup'
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_dopamine}` AS
+				CREATE OR REPLACE TABLE `{sepsis_dopamine}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -1087,7 +1287,8 @@ class DopamineComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_dopamine":self.config_dict['sepsis_dopamine'] + '_prior' if self.prior else self.config_dict['sepsis_dopamine']})
+							"sepsis_dopamine":self.config_dict['sepsis_dopamine'] + '_prior' if self.prior else self.config_dict['sepsis_dopamine'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -1095,6 +1296,8 @@ class DopamineComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_drug_extract']:
+			return self.get_drug_extract_query(format_query=format_query)
 		query = '''
 				WITH dopamine_list AS (
 					SELECT 
@@ -1171,13 +1374,18 @@ class DobutamineComponent(Component):
 	Class to get dobutamine drug exposure for cohort.
 	Dosage amounts are unavailable in STARR-OMOP, so only the presence of the drug exposure will be used.
 	'''
+	table_key = 'sepsis_dobutamine'
+	values_ctes = ['dobutamine_from_drug_exposure_with_name']
+	drug_exposures = {'dobutamine_from_drug_exposure_with_name': ('dobutamine', 'dobutamine_type')}
+	rollup_cte = 'dobutamine_rollup'
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_dobutamine}` AS
+				CREATE OR REPLACE TABLE `{sepsis_dobutamine}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -1190,7 +1398,8 @@ class DobutamineComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_dobutamine":self.config_dict['sepsis_dobutamine'] + '_prior' if self.prior else self.config_dict['sepsis_dobutamine']})
+							"sepsis_dobutamine":self.config_dict['sepsis_dobutamine'] + '_prior' if self.prior else self.config_dict['sepsis_dobutamine'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -1198,6 +1407,8 @@ class DobutamineComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_drug_extract']:
+			return self.get_drug_extract_query(format_query=format_query)
 		query = '''
 				WITH dobutamine_list AS (
 					SELECT 
@@ -1274,13 +1485,18 @@ class EpinephrineComponent(Component):
 	Class to get epinephrine drug exposure for cohort.
 	Dosage amounts are unavailable in STARR-OMOP, so only the presence of the drug exposure will be used.
 	'''
+	table_key = 'sepsis_epinephrine'
+	values_ctes = ['epinephrine_from_drug_exposure_with_name']
+	drug_exposures = {'epinephrine_from_drug_exposure_with_name': ('epinephrine', 'epinephrine_type')}
+	rollup_cte = 'epinephrine_rollup'
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_epinephrine}` AS
+				CREATE OR REPLACE TABLE `{sepsis_epinephrine}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -1293,7 +1509,8 @@ class EpinephrineComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_epinephrine":self.config_dict['sepsis_epinephrine'] + '_prior' if self.prior else self.config_dict['sepsis_epinephrine']})
+							"sepsis_epinephrine":self.config_dict['sepsis_epinephrine'] + '_prior' if self.prior else self.config_dict['sepsis_epinephrine'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -1301,6 +1518,8 @@ class EpinephrineComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_drug_extract']:
+			return self.get_drug_extract_query(format_query=format_query)
 		query = '''
 				WITH epinephrine_list AS (
 					SELECT 
@@ -1377,13 +1596,18 @@ class NorepinephrineComponent(Component):
 	Class to get norepinephrine drug exposure for cohort.
 	Dosage amounts are unavailable in STARR-OMOP, so only the presence of the drug exposure will be used.
 	'''
+	table_key = 'sepsis_norepinephrine'
+	values_ctes = ['norepinephrine_from_drug_exposure_with_name']
+	drug_exposures = {'norepinephrine_from_drug_exposure_with_name': ('norepinephrine', 'norepinephrine_type')}
+	rollup_cte = 'norepinephrine_rollup'
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_norepinephrine}` AS
+				CREATE OR REPLACE TABLE `{sepsis_norepinephrine}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -1396,7 +1620,8 @@ class NorepinephrineComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_norepinephrine":self.config_dict['sepsis_norepinephrine'] + '_prior' if self.prior else self.config_dict['sepsis_norepinephrine']})
+							"sepsis_norepinephrine":self.config_dict['sepsis_norepinephrine'] + '_prior' if self.prior else self.config_dict['sepsis_norepinephrine'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -1404,6 +1629,8 @@ class NorepinephrineComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_drug_extract']:
+			return self.get_drug_extract_query(format_query=format_query)
 		query = '''
 				WITH norepinephrine_list AS (
 					SELECT 
@@ -1475,17 +1702,173 @@ class NorepinephrineComponent(Component):
 		else:
 			return query.format_map(self.config_dict)
 
+class VasopressorComponent(Component): 
+	'''
+	Class to get dopamine, dobutamine, epinephrine and norepinephrine drug exposure for cohort in a single scan of drug_exposure.
+	Writes the max_*_days columns of the four individual vasopressor components to one table.
+	Dosage amounts are unavailable in STARR-OMOP, so only the presence of the drug exposure will be used.
+	'''
+	table_key = 'sepsis_vasopressor'
+	values_ctes = ['vasopressor_from_drug_exposure']
+	rollup_cte = 'vasopressor_rollup'
+	vasopressors = {
+		'dopamine': 21600284,
+		'dobutamine': 21600287,
+		'epinephrine': 21600303,
+		'norepinephrine': 21600283,
+	}
+	
+	def __init__(self, prior=False, *args, **kwargs):
+		Component.__init__(self, *args, **kwargs)
+		self.prior = prior
+	
+	def get_component_query(self, format_query=True):
+		query = '''
+				CREATE OR REPLACE TABLE `{sepsis_vasopressor}` {table_options_str} AS
+				{values_query}
+				{window_query}
+				{rollup_query} 
+				select * from vasopressor_rollup
+				'''
+		if not format_query:
+			pass
+		else:
+			query = query.format_map(
+						{**{"values_query":self.get_values_query(), 
+							"window_query":self.get_window_query(), 
+							"rollup_query":self.get_rollup_query()}, 
+							"sepsis_vasopressor":self.get_output_tables()[0],
+							"table_options_str":self.config_dict['table_options_str']})
+			
+		if self.config_dict['print_query']:
+			print(query)
+			
+		return query
+
+	def get_input_tables(self):
+		tables = Component.get_input_tables(self)
+		if self.config_dict['use_drug_extract']:
+			tables.append(self.config_dict['sepsis_drug'])
+		return tables
+
+	def get_values_query(self, format_query=True):
+		if self.config_dict['use_drug_extract']:
+			query = '''
+				WITH vasopressor_from_drug_exposure AS ( 
+					SELECT 
+						person_id, 
+						drug AS vasopressor, 
+						drug_exposure_start_DATETIME, 
+						drug_exposure_end_DATETIME
+					FROM `{sepsis_drug}`
+					WHERE drug IN ({vasopressor_names})
+				),
+				'''
+			if not format_query:
+				return query
+			else:
+				return query.format_map({
+					**self.config_dict,
+					**{"vasopressor_names":', '.join(f"'{vasopressor}'" for vasopressor in self.vasopressors)}
+				})
+		query = '''
+				WITH vasopressor_ancestors AS (
+					SELECT * FROM UNNEST([
+						{vasopressor_structs}
+					])
+				),
+				vasopressor_list AS (
+					SELECT 
+						vasopressor, 
+						descendant_concept_id AS concept_id
+					FROM {dataset_project}.{dataset}.concept_ancestor
+					INNER JOIN vasopressor_ancestors
+					USING (ancestor_concept_id)
+				),
+				vasopressor_from_drug_exposure AS ( 
+					SELECT 
+						drug.person_id, 
+						vasopressor_list.vasopressor, 
+						drug.drug_exposure_start_DATETIME, 
+						drug.drug_exposure_end_DATETIME
+					FROM {dataset_project}.{dataset}.drug_exposure AS drug
+					INNER JOIN vasopressor_list
+					ON drug.drug_concept_id = vasopressor_list.concept_id
+				),
+				'''
+		if not format_query:
+			return query
+		else:
+			return query.format_map({
+				**self.config_dict,
+				**{"vasopressor_structs":',\n\t\t\t\t\t\t'.join(
+					f"STRUCT('{vasopressor}' AS vasopressor, {concept_id} AS ancestor_concept_id)" 
+					for vasopressor, concept_id in self.vasopressors.items()
+				)}
+			})
+
+	def get_window_query(self, format_query=True):
+		query = '''
+				vasopressor_window AS (
+					SELECT 
+						susp_inf_rollup.person_id, 
+						susp_inf_rollup.admit_date, 
+						susp_inf_rollup.sepsis_index_date,
+						vasopressor.vasopressor,
+						vasopressor.drug_exposure_start_DATETIME, 
+						vasopressor.drug_exposure_end_DATETIME
+					FROM {suspected_infection} AS susp_inf_rollup
+					LEFT JOIN vasopressor_from_drug_exposure AS vasopressor
+					USING (person_id)
+					WHERE
+						{window}
+				),
+				'''
+		
+		if not format_query:
+			return query
+		else:
+			return query.format_map({**self.config_dict,**{"window":self.config_dict['drug_window_prior'] if self.prior else self.config_dict['drug_window']}})
+
+	def get_rollup_query(self, format_query=True):
+		query = '''
+				vasopressor_rollup AS (
+					SELECT 
+						person_id, 
+						admit_date, 
+						{max_days}
+					FROM vasopressor_window
+					GROUP BY person_id, admit_date
+				)
+				'''
+		if not format_query:
+			return query
+		else:
+			return query.format_map({
+				**self.config_dict,
+				**{"max_days":',\n\t\t\t\t\t\t'.join(
+					f"MAX(IF(vasopressor = '{vasopressor}', datetime_diff(drug_exposure_end_DATETIME, drug_exposure_start_DATETIME, DAY) + 1, NULL)) as max_{vasopressor}_days"
+					for vasopressor in self.vasopressors
+				)}
+			})
+
 class MeanArterialPressureComponent(Component): 
 	'''
 	Class to get MAP measurement for cohort.
 	'''
+	table_key = 'sepsis_map'
+	values_ctes = ['mean_arterial_pressure_from_measurement']
+	rollup_cte = 'mean_arterial_pressure_rollup'
+	measurement_analytes = {'mean_arterial_pressure_from_measurement': 'map'}
+	daily_aggregate = 'min'
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_map}` AS
+				CREATE OR REPLACE TABLE `{sepsis_map}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -1498,7 +1881,8 @@ class MeanArterialPressureComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_map":self.config_dict['sepsis_map'] + '_prior' if self.prior else self.config_dict['sepsis_map']})
+							"sepsis_map":self.config_dict['sepsis_map'] + '_prior' if self.prior else self.config_dict['sepsis_map'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -1506,6 +1890,10 @@ class MeanArterialPressureComponent(Component):
 		return query
 
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_daily_aggregates']:
+			return self.get_daily_aggregate_query(format_query)
+		if self.config_dict['use_measurement_extract']:
+			return self.get_measurement_extract_query(format_query)
 		query = '''
 				WITH mean_arterial_pressure_from_measurement AS (
 					SELECT 
@@ -1566,13 +1954,20 @@ class UrineComponent(Component):
 	Class to get urine measurement for cohort.
 	Urine must be summed over day for each person during window.
 	'''
+	table_key = 'sepsis_urine'
+	reads_flowsheet = True
+	flowsheet_admission_days = True
+	values_ctes = ['urine_from_measurement', 'urine_24_from_measurement']
+	rollup_cte = 'urine_rollup'
+	measurement_analytes = {'urine_from_measurement': 'urine', 'urine_24_from_measurement': 'urine_24'}
+	
 	def __init__(self, prior=False, *args, **kwargs):
 		Component.__init__(self, *args, **kwargs)
 		self.prior = prior
 	
 	def get_component_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_urine}` AS
+				CREATE OR REPLACE TABLE `{sepsis_urine}` {table_options_str} AS
 				{values_query}
 				{window_query}
 				{rollup_query} 
@@ -1585,14 +1980,23 @@ class UrineComponent(Component):
 						{**{"values_query":self.get_values_query(), 
 							"window_query":self.get_window_query(), 
 							"rollup_query":self.get_rollup_query()}, 
-							"sepsis_urine":self.config_dict['sepsis_urine'] + '_prior' if self.prior else self.config_dict['sepsis_urine']})
+							"sepsis_urine":self.config_dict['sepsis_urine'] + '_prior' if self.prior else self.config_dict['sepsis_urine'],
+							"table_options_str":self.config_dict['table_options_str']})
 			
 		if self.config_dict['print_query']:
 			print(query)
 			
 		return query
 
+	def get_input_tables(self):
+		tables = Component.get_input_tables(self)
+		if self.config_dict['use_observation_bounds']:
+			tables = [table for table in tables if table != self.get_flowsheet_table()] + [self.config_dict['sepsis_obs_bounds']]
+		return tables
+
 	def get_values_query(self, format_query=True):
+		if self.config_dict['use_measurement_extract']:
+			return self.get_measurement_extract_query(format_query)
 		query = '''
 				WITH urine_from_measurement AS (
 					SELECT 
@@ -1650,6 +2054,60 @@ class UrineComponent(Component):
 						{window}
 					ORDER BY person_id, admit_date, measurement_DATETIME
 				),
+				{observation_time_query}
+				'''
+		if not format_query:
+			return query
+		else:
+			return query.format_map({
+				**self.config_dict,
+				**{"window":self.config_dict['meas_window_prior'] if self.prior else self.config_dict['meas_window'],
+				   "observation_time_query":self.get_observation_time_query()}
+			})
+
+	def get_observation_time_query(self, format_query=True):
+		'''
+		Returns the first and last charted observation times on the admission days of the urine_window persons, used to scale partial days.
+		The _24 CTEs read urine_window as well, and the discharge CTEs the admission day.
+		'''
+		if self.config_dict['use_observation_bounds']:
+			query = '''
+				urine_admission_days AS (
+					SELECT DISTINCT 
+						person_id, 
+						admit_date
+					FROM urine_window
+				),
+				urine_admit_time AS (
+					SELECT 
+						person_id, 
+						MIN(min_observation_datetime) AS ext_urine_datetime,
+						EXTRACT(HOUR FROM MIN(min_observation_datetime)) AS hour, 
+						(24-EXTRACT(HOUR FROM MIN(min_observation_datetime))) AS adjust_hours
+					FROM urine_admission_days
+					INNER JOIN `{sepsis_obs_bounds}` AS bounds USING (person_id)
+					WHERE urine_admission_days.admit_date = bounds.observation_date
+					GROUP BY person_id
+				),
+				urine_discharge_time AS (
+					SELECT 
+						person_id, 
+						MAX(max_observation_datetime) AS ext_urine_datetime,
+						EXTRACT(HOUR FROM MAX(max_observation_datetime)) AS adjust_hours
+					FROM urine_admission_days
+					INNER JOIN `{sepsis_obs_bounds}` AS bounds USING (person_id)
+					WHERE urine_admission_days.admit_date = bounds.observation_date
+					GROUP BY person_id
+				),
+				urine_24_admit_time AS (
+					SELECT * FROM urine_admit_time
+				),
+				urine_24_discharge_time AS (
+					SELECT * FROM urine_discharge_time
+				),
+				'''
+		else:
+			query = '''
 				urine_admit_time AS (
 					SELECT 
 						person_id, 
@@ -1700,7 +2158,7 @@ class UrineComponent(Component):
 		if not format_query:
 			return query
 		else:
-			return query.format_map({**self.config_dict,**{"window":self.config_dict['meas_window_prior'] if self.prior else self.config_dict['meas_window']}})
+			return query.format_map(self.config_dict)
 
 	def get_rollup_query(self, format_query=True):
 		query = '''
@@ -2,9 +2,26 @@ import os
 from prediction_utils.extraction_utils.database import BQDatabase
 
 class Component:
-	def __init__(self, *args, **kwargs):
+	table_key = None
+	reads_flowsheet = False
+	# UPPER(display_name) LIKE patterns of the flowsheet rows the component reads, for the targeted flowsheet extract
+	flowsheet_display_names = []
+	# Whether the component reads every flowsheet row on the admission days of the cohort
+	flowsheet_admission_days = False
+	values_ctes = []
+	rollup_cte = None
+	measurement_analytes = {}
+	respiratory_measures = {}
+	drug_exposures = {}
+	# Daily aggregate (min or max) of the measurement store equivalent to the component rollup, if any
+	daily_aggregate = None
+	partition_column = 'admit_date'
+	cluster_columns = ['person_id']
+	prior = False
+	
+	def __init__(self, *args, db=None, **kwargs):
 		self.config_dict = self.get_config_dict(**kwargs)
-		self.db = BQDatabase(**self.config_dict)
+		self.db = db if db is not None else BQDatabase(**self.config_dict)
 	
 	def get_component_query(self):
 		raise NotImplementedError
@@ -20,6 +37,227 @@ class Component:
 	
 	def create_component_table(self):
 		self.db.execute_sql(self.get_component_query())
+	
+	def get_output_tables(self):
+		'''
+		Returns the tables written by the component query.
+		'''
+		table = self.config_dict[self.table_key]
+		return [table + '_prior' if self.prior else table]
+	
+	def get_input_tables(self):
+		'''
+		Returns the pipeline tables read by the component query. Source OMOP tables are not listed.
+		'''
+		tables = [self.config_dict['suspected_infection']]
+		if self.config_dict['use_respiratory_extract'] and self.respiratory_measures:
+			tables.append(self.config_dict['sepsis_resp_flowsheet'])
+		elif self.reads_flowsheet:
+			tables.append(self.get_flowsheet_table())
+		if self.config_dict['use_daily_aggregates'] and self.daily_aggregate:
+			tables.append(self.config_dict['sepsis_daily_measurement'])
+		elif self.config_dict['use_measurement_extract'] and self.measurement_analytes:
+			tables.append(self.config_dict['sepsis_measurement'])
+		if self.config_dict['use_drug_extract'] and self.drug_exposures:
+			tables.append(self.config_dict['sepsis_drug'])
+		return tables
+	
+	def get_measurement_extract_query(self, format_query=True):
+		'''
+		Returns the values CTEs of the component read from the shared measurement extract instead of the measurement table.
+		'''
+		query = 'WITH ' + ',\n\t\t\t\t'.join(
+			f'''{cte} AS (
+					SELECT 
+						person_id, 
+						measurement_DATETIME, 
+						value_as_number
+					FROM `{{sepsis_measurement}}`
+					WHERE analyte = '{analyte}'
+				)''' for cte, analyte in self.measurement_analytes.items()
+		) + ',\n'
+		if not format_query:
+			return query
+		else:
+			return query.format_map(self.config_dict)
+	
+	def get_daily_aggregate_query(self, format_query=True):
+		'''
+		Returns the values CTEs of the component read from the daily measurement store, one row per person, analyte and day.
+		Only valid for components whose windows are whole days and whose rollup is the daily_aggregate of the values.
+		'''
+		query = 'WITH ' + ',\n\t\t\t\t'.join(
+			f'''{cte} AS (
+					SELECT 
+						person_id, 
+						CAST(measurement_date AS DATETIME) AS measurement_DATETIME, 
+						{self.daily_aggregate}_value AS value_as_number
+					FROM `{{sepsis_daily_measurement}}`
+					WHERE analyte = '{analyte}'
+				)''' for cte, analyte in self.measurement_analytes.items()
+		) + ',\n'
+		if not format_query:
+			return query
+		else:
+			return query.format_map(self.config_dict)
+	
+	def get_respiratory_extract_query(self, format_query=True, leading_with=True):
+		'''
+		Returns the flowsheet values CTEs of the component read from the shared respiratory flowsheet extract.
+		'''
+		query = ('WITH ' if leading_with else '') + ',\n\t\t\t\t'.join(
+			f'''{cte} AS (
+					SELECT 
+						person_id, 
+						observation_datetime, 
+						{value} AS {alias}
+					FROM `{{sepsis_resp_flowsheet}}`
+					WHERE measure = '{measure}'
+				)''' for cte, (measure, value, alias) in self.respiratory_measures.items()
+		) + ',\n'
+		if not format_query:
+			return query
+		else:
+			return query.format_map(self.config_dict)
+	
+	def get_drug_extract_query(self, format_query=True, leading_with=True):
+		'''
+		Returns the drug exposure values CTEs of the component read from the shared drug exposure extract.
+		'''
+		query = ('WITH ' if leading_with else '') + ',\n\t\t\t\t'.join(
+			f'''{cte} AS (
+					SELECT 
+						person_id, 
+						drug_concept_id, 
+						drug_exposure_start_DATETIME, 
+						drug_exposure_end_DATETIME, 
+						drug_type AS {alias}
+					FROM `{{sepsis_drug}}`
+					WHERE drug = '{drug}'
+				)''' for cte, (drug, alias) in self.drug_exposures.items()
+		) + ',\n'
+		if not format_query:
+			return query
+		else:
+			return query.format_map(self.config_dict)
+	
+	def get_fio2_asof_query(self, reading, format_query=True):
+		'''
+		Returns a {reading}_fiO2_window CTE pairing every reading of {reading}_window with the latest FiO2 of fiO2_window at or before it.
+		The pairing is a running LAST_VALUE over the time-ordered union of both streams, instead of a join of every FiO2 to every reading.
+		FiO2 sorts before a reading charted at the same time, and of several FiO2 charted at the same time the highest is kept, 
+		which is the one the lowest ratio was taken with.
+		'''
+		query = '''
+				{reading}_fiO2_stream AS (
+					SELECT 
+						person_id, 
+						sepsis_index_date, 
+						fiO2_datetime AS event_datetime, 
+						0 AS stream_order, 
+						NULL AS admit_date, 
+						MAX(fiO2) AS fiO2, 
+						fiO2_datetime, 
+						NULL AS {reading}
+					FROM fiO2_window
+					GROUP BY person_id, sepsis_index_date, fiO2_datetime
+					UNION ALL
+					SELECT 
+						person_id, 
+						sepsis_index_date, 
+						{reading}_datetime AS event_datetime, 
+						1 AS stream_order, 
+						admit_date, 
+						NULL AS fiO2, 
+						NULL AS fiO2_datetime, 
+						{reading}
+					FROM {reading}_window
+				),
+				{reading}_fiO2_asof AS (
+					SELECT 
+						*, 
+						LAST_VALUE(fiO2 IGNORE NULLS) OVER latest AS latest_fiO2, 
+						LAST_VALUE(fiO2_datetime IGNORE NULLS) OVER latest AS latest_fiO2_datetime
+					FROM {reading}_fiO2_stream
+					WINDOW latest AS (
+						PARTITION BY person_id, sepsis_index_date 
+						ORDER BY event_datetime, stream_order 
+						ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+					)
+				),
+				{reading}_fiO2_window AS (
+					SELECT 
+						person_id, 
+						admit_date, 
+						sepsis_index_date, 
+						latest_fiO2 AS fiO2, 
+						latest_fiO2_datetime AS fiO2_datetime, 
+						{reading}, 
+						event_datetime AS {reading}_datetime, 
+						{reading}/(NULLIF(latest_fiO2, 0)) AS {reading}fiO2_ratio, 
+						datetime_diff(event_datetime, latest_fiO2_datetime, MINUTE) as minutes_fiO2_{reading}
+					FROM {reading}_fiO2_asof
+					WHERE stream_order = 1 AND latest_fiO2_datetime IS NOT NULL
+				),
+				'''
+		if not format_query:
+			return query
+		else:
+			return query.format_map({**self.config_dict, **{"reading":reading}})
+	
+	def get_fio2_asof_rollup_query(self, reading, format_query=True):
+		'''
+		Returns the {reading}_fiO2_rollup CTE over the as-of pairs of get_fio2_asof_query, keeping pairs at most 24 hours apart.
+		'''
+		query = '''
+				{reading}_fiO2_rollup AS (
+					SELECT 
+						person_id, 
+						admit_date, 
+						MIN({reading}fiO2_ratio) as min_{reading}fiO2_ratio
+					FROM {reading}_fiO2_window 
+					WHERE minutes_fiO2_{reading} <= 24*60
+					GROUP BY person_id, admit_date
+				)
+				'''
+		if not format_query:
+			return query
+		else:
+			return query.format_map({**self.config_dict, **{"reading":reading}})
+	
+	def get_person_bounds_query(self):
+		'''
+		Returns a person_bounds CTE with, for each cohort person, the range of event datetimes any component window can reach.
+		Empty unless cohort_scoped_extracts is set.
+		'''
+		if not self.config_dict['cohort_scoped_extracts']:
+			return ''
+		query = '''person_bounds AS (
+					SELECT 
+						person_id, 
+						DATETIME_SUB(DATETIME_TRUNC(CAST(MIN(admit_date) AS DATETIME), DAY), INTERVAL {extract_lookback_days} DAY) AS min_datetime, 
+						DATETIME_ADD(DATETIME_TRUNC(CAST(MAX(discharge_date) AS DATETIME), DAY), INTERVAL {extract_lookahead_days} DAY) AS max_datetime
+					FROM `{admission_rollup}`
+					GROUP BY person_id
+				),
+				'''
+		return query.format_map(self.config_dict)
+	
+	def get_person_bounds_join(self, person_column, start_column, end_column=None):
+		'''
+		Returns the join restricting events to the person_bounds of cohort persons. Events with an end overlap the range.
+		'''
+		if not self.config_dict['cohort_scoped_extracts']:
+			return ''
+		if end_column is None:
+			condition = f'{start_column} BETWEEN person_bounds.min_datetime AND person_bounds.max_datetime'
+		else:
+			condition = f'{start_column} <= person_bounds.max_datetime AND COALESCE({end_column}, {start_column}) >= person_bounds.min_datetime'
+		return f'''INNER JOIN person_bounds
+				ON {person_column} = person_bounds.person_id AND {condition}'''
+	
+	def get_flowsheet_table(self):
+		return '{dataset_project}.{rs_dataset}.{ext_flwsht_table}'.format_map(self.config_dict)
 
 	def get_defaults(self):
 		return {
@@ -36,6 +274,19 @@ class Component:
 			"limit": None,
 			"min_stay_hour":0,
 			"print_query":False,
+			"use_measurement_extract":False,
+			"use_respiratory_extract":False,
+			"use_drug_extract":False,
+			"use_daily_aggregates":False,
+			"use_observation_bounds":False,
+			"asof_fio2_join":False,
+			"bounded_infection_join":False,
+			"daily_store_refresh_days":3,
+			"cohort_scoped_extracts":False,
+			"extract_lookback_days":11,
+			"extract_lookahead_days":3,
+			"partition_tables":False,
+			"partition_granularity":"MONTH",
 			"meas_window_prior":'''DATE_SUB(CAST(sepsis_index_date AS DATE), INTERVAL 2 DAY) > CAST(measurement_DATETIME AS DATE) AND
 								   DATE_SUB(CAST(sepsis_index_date AS DATE), INTERVAL 10 DAY) <= CAST(measurement_DATETIME AS DATE)''',
 			"meas_window":'''CAST(sepsis_index_date AS DATE) >= CAST(DATETIME_SUB(measurement_DATETIME, INTERVAL 2 DAY) AS DATE) AND
@@ -100,4 +351,77 @@ class Component:
 			)
 			else config_dict["gcloud_project"]
 		)
-		return config_dict
\ No newline at end of file
+		config_dict["table_options_str"] = self.get_table_options_str(config_dict)
+		return config_dict
+	
+	def get_table_options_str(self, config_dict):
+		'''
+		Returns the PARTITION BY and CLUSTER BY options of the component table, if partition_tables is set.
+		'''
+		if not config_dict["partition_tables"]:
+			return ""
+		options = []
+		if self.partition_column:
+			options.append(f"PARTITION BY DATE_TRUNC({self.partition_column}, {config_dict['partition_granularity']})")
+		if self.cluster_columns:
+			options.append(f"CLUSTER BY {', '.join(self.cluster_columns)}")
+		return ' '.join(options)
+
+class FusedComponent:
+	'''
+	Builds the current and prior window tables of a component in a single BigQuery script.
+	The source rows of the component are scanned once into session temp tables restricted to the cohort,
+	and both window rollups are computed from those temp tables.
+	'''
+	def __init__(self, component_class, *args, **kwargs):
+		self.component_class = component_class
+		self.current = component_class(*args, **kwargs)
+		self.prior = component_class(*args, prior=True, **kwargs)
+		self.config_dict = self.current.config_dict
+		self.db = self.current.db
+	
+	def get_component_query(self, format_query=True):
+		query = '\n'.join(
+			[self.get_values_table_query(cte) for cte in self.component_class.values_ctes] +
+			[self.get_rollup_table_query(component) for component in (self.current, self.prior)]
+		)
+		if self.config_dict['print_query']:
+			print(query)
+		
+		return query
+	
+	def get_values_table_query(self, cte):
+		query = '''
+				CREATE OR REPLACE TEMP TABLE {cte} AS
+				{values_query}
+				SELECT * FROM {cte}
+				WHERE person_id IN (SELECT person_id FROM `{suspected_infection}`);
+				'''
+		return query.format_map({
+			**self.config_dict,
+			**{"cte":cte, "values_query":self.current.get_values_query().rstrip().rstrip(',')}
+		})
+	
+	def get_rollup_table_query(self, component):
+		query = '''
+				CREATE OR REPLACE TABLE `{table}` {table_options_str} AS
+				WITH {window_query}
+				{rollup_query}
+				SELECT * FROM {rollup_cte};
+				'''
+		return query.format_map({
+			"table":component.get_output_tables()[0],
+			"window_query":component.get_window_query(),
+			"rollup_query":component.get_rollup_query(),
+			"rollup_cte":self.component_class.rollup_cte,
+			"table_options_str":component.config_dict['table_options_str']
+		})
+	
+	def create_component_table(self):
+		self.db.execute_sql(self.get_component_query())
+	
+	def get_output_tables(self):
+		return self.current.get_output_tables() + self.prior.get_output_tables()
+	
+	def get_input_tables(self):
+		return self.current.get_input_tables()
@@ -0,0 +1,487 @@
+from sepsis_labeler.component_base import Component
+from sepsis_labeler.component import VasopressorComponent
+
+class MeasurementExtract(Component):
+	'''
+	Class to extract every measurement analyte used by the components in a single scan of the measurement table.
+	Writes a narrow (person_id, analyte, measurement_DATETIME, value_as_number) table.
+	Units are normalized the same way as in the individual components.
+	'''
+	table_key = 'sepsis_measurement'
+	partition_column = None
+	cluster_columns = ['analyte', 'person_id']
+	
+	# concept_ids: concepts defining the analyte
+	# descendants: also include descendants of concept_ids from concept_ancestor
+	# include_self: include concept_ids themselves (concept_ancestor only lists them when descendants are used)
+	# value: expression for the normalized value
+	# filter: row filter applied to the raw measurement, if any
+	analytes = {
+		'blood_culture': {
+			'concept_ids': [4107893],
+			'descendants': True,
+			'include_self': False,
+			'valid_only': False,
+			'value': 'measure.value_as_number',
+			'filter': None,
+		},
+		'platelet': {
+			'concept_ids': [37037425, 40654106],
+			'descendants': True,
+			'include_self': True,
+			'valid_only': True,
+			'value': 'measure.value_as_number',
+			'filter': 'measure.value_as_number IS NOT NULL AND measure.value_as_number > 0',
+		},
+		'creatinine': {
+			'concept_ids': [37029387, 4013964, 2212294, 3051825],
+			'descendants': True,
+			'include_self': True,
+			'valid_only': True,
+			'value': '''case
+							when unit_concept_id = 8749 then value_as_number / 0.0113122 -- umol/l -> mg/dL
+							when unit_concept_id = 8837 then value_as_number / 1000 -- ug/dL -> mg/dL
+							else value_as_number 
+						end''',
+			'filter': 'measure.value_as_number IS NOT NULL AND measure.value_as_number > 0',
+		},
+		'bilirubin': {
+			'concept_ids': [3024128, 4230543],
+			'descendants': True,
+			'include_self': True,
+			'valid_only': True,
+			'value': 'measure.value_as_number',
+			'filter': 'measure.value_as_number IS NOT NULL AND measure.value_as_number > 0',
+		},
+		'lactate': {
+			'concept_ids': [3047181, 40762125, 3014111, 3020138],
+			'descendants': True,
+			'include_self': True,
+			'valid_only': True,
+			'value': '''case
+							when unit_concept_id = 8840 then value_as_number * 9.0 -- mg/dL -> mmol/L
+							when unit_concept_id = 8837 then value_as_number / 0.001 * 9.0 -- ug/dL -> mmol/L
+							else value_as_number 
+						end''',
+			'filter': 'measure.value_as_number IS NOT NULL AND measure.value_as_number > 0',
+		},
+		'gcs': {
+			'concept_ids': [3032652],
+			'descendants': False,
+			'include_self': True,
+			'valid_only': False,
+			'value': 'measure.value_as_number',
+			'filter': 'measure.value_as_number >= 3 AND measure.value_as_number <= 15',
+		},
+		'map': {
+			'concept_ids': [3027598],
+			'descendants': False,
+			'include_self': True,
+			'valid_only': False,
+			'value': 'measure.value_as_number',
+			'filter': 'measure.value_as_number IS NOT NULL AND measure.value_as_number >= 10',
+		},
+		'pao2': {
+			'concept_ids': [3027801],
+			'descendants': False,
+			'include_self': True,
+			'valid_only': False,
+			'value': 'measure.value_as_number',
+			'filter': 'measure.value_as_number IS NOT NULL',
+		},
+		'urine': {
+			'concept_ids': [45876241],
+			'descendants': False,
+			'include_self': True,
+			'valid_only': False,
+			'value': 'measure.value_as_number',
+			'filter': 'measure.value_as_number >= 0 AND measure.value_as_number IS NOT NULL',
+		},
+		'urine_24': {
+			'concept_ids': [3012565],
+			'descendants': False,
+			'include_self': True,
+			'valid_only': False,
+			'value': 'measure.value_as_number',
+			'filter': 'measure.value_as_number >= 0 AND measure.value_as_number IS NOT NULL',
+		},
+	}
+	
+	def __init__(self, *args, **kwargs):
+		Component.__init__(self, *args, **kwargs)
+	
+	def get_input_tables(self):
+		return [self.config_dict['admission_rollup']] if self.config_dict['cohort_scoped_extracts'] else []
+	
+	def get_component_query(self, format_query=True):
+		query = '''
+				CREATE OR REPLACE TABLE `{sepsis_measurement}` {table_options_str} AS
+				{values_query}
+				SELECT 
+					measure.person_id, 
+					analyte_concepts.analyte, 
+					measure.measurement_DATETIME, 
+					CASE analyte_concepts.analyte
+						{value_cases}
+					END AS value_as_number
+				FROM {dataset_project}.{dataset}.measurement AS measure
+				INNER JOIN analyte_concepts
+				ON measure.measurement_concept_id = analyte_concepts.concept_id
+				{person_bounds_join}
+				WHERE 
+					{filters}
+				'''
+		if not format_query:
+			pass
+		else:
+			query = query.format_map(
+						{**self.config_dict,
+						 **{"values_query":self.get_values_query(),
+							"value_cases":self.get_value_cases(),
+							"filters":self.get_filters(),
+							"person_bounds_join":self.get_person_bounds_join('measure.person_id', 'measure.measurement_DATETIME')}})
+		
+		if self.config_dict['print_query']:
+			print(query)
+		
+		return query
+	
+	def get_values_query(self, format_query=True):
+		query = '''
+				WITH {person_bounds_query}analyte_ancestors AS (
+					SELECT * FROM UNNEST([
+						{analyte_structs}
+					])
+				),
+				analyte_concepts AS (
+					SELECT DISTINCT 
+						analyte, 
+						concept_id
+					FROM (
+						SELECT 
+							analyte, 
+							c.concept_id
+						FROM analyte_ancestors
+						INNER JOIN {dataset_project}.{dataset}.concept c
+						ON c.concept_id = analyte_ancestors.ancestor_concept_id
+						WHERE include_self
+						UNION ALL
+						SELECT 
+							analyte, 
+							c.concept_id
+						FROM analyte_ancestors
+						INNER JOIN {dataset_project}.{dataset}.concept_ancestor ca
+						ON ca.ancestor_concept_id = analyte_ancestors.ancestor_concept_id
+						INNER JOIN {dataset_project}.{dataset}.concept c
+						ON c.concept_id = ca.descendant_concept_id
+						WHERE descendants AND (NOT valid_only OR c.invalid_reason IS NULL)
+					)
+				)
+				'''
+		if not format_query:
+			return query
+		else:
+			return query.format_map({
+				**self.config_dict, 
+				**{"analyte_structs":self.get_analyte_structs(), "person_bounds_query":self.get_person_bounds_query()}
+			})
+	
+	def get_analyte_structs(self):
+		return ',\n\t\t\t\t\t\t'.join(
+			f"STRUCT('{analyte}' AS analyte, {concept_id} AS ancestor_concept_id, "
+			f"{str(spec['descendants']).upper()} AS descendants, "
+			f"{str(spec['include_self']).upper()} AS include_self, "
+			f"{str(spec['valid_only']).upper()} AS valid_only)"
+			for analyte, spec in self.analytes.items()
+			for concept_id in spec['concept_ids']
+		)
+	
+	def get_value_cases(self):
+		return '\n\t\t\t\t\t\t'.join(
+			f"WHEN '{analyte}' THEN {spec['value']}" for analyte, spec in self.analytes.items()
+		)
+	
+	def get_filters(self):
+		return '\n\t\t\t\t\tOR '.join(
+			f"(analyte_concepts.analyte = '{analyte}' AND {spec['filter']})" if spec['filter'] else f"analyte_concepts.analyte = '{analyte}'"
+			for analyte, spec in self.analytes.items()
+		)
+
+class DailyMeasurementStore(MeasurementExtract):
+	'''
+	Class to maintain a store of daily (person_id, analyte, measurement_date) aggregates of the measurement analytes.
+	The component windows are whole days and the rollups of the day-level analytes only take the MIN or MAX within them,
+	so components can read one row per person, analyte and day instead of the raw measurements.
+	The store is not restricted to a cohort and is refreshed incrementally: days from daily_store_refresh_days
+	before its latest day onwards are recomputed, to pick up late-arriving measurements.
+	'''
+	table_key = 'sepsis_daily_measurement'
+	partition_column = 'measurement_date'
+	cluster_columns = ['analyte', 'person_id']
+	# Blood culture and PaO2 are matched on their exact datetimes, so they are not stored
+	analytes = {
+		analyte: spec for analyte, spec in MeasurementExtract.analytes.items() if analyte not in ('blood_culture', 'pao2')
+	}
+	
+	def __init__(self, *args, **kwargs):
+		MeasurementExtract.__init__(self, *args, **kwargs)
+	
+	def get_input_tables(self):
+		return []
+	
+	def get_component_query(self, format_query=True):
+		query = '''
+				CREATE TABLE IF NOT EXISTS `{sepsis_daily_measurement}` (
+					person_id INT64,
+					analyte STRING,
+					measurement_date DATE,
+					min_value FLOAT64,
+					max_value FLOAT64,
+					sum_value FLOAT64,
+					value_count INT64
+				)
+				PARTITION BY DATE_TRUNC(measurement_date, MONTH)
+				CLUSTER BY analyte, person_id;
+				DELETE FROM `{sepsis_daily_measurement}`
+				WHERE measurement_date >= (
+					SELECT DATE_SUB(MAX(measurement_date), INTERVAL {daily_store_refresh_days} DAY)
+					FROM `{sepsis_daily_measurement}`
+				);
+				INSERT INTO `{sepsis_daily_measurement}` (person_id, analyte, measurement_date, min_value, max_value, sum_value, value_count)
+				{values_query},
+				analyte_values AS (
+					SELECT 
+						measure.person_id, 
+						analyte_concepts.analyte, 
+						CAST(measure.measurement_DATETIME AS DATE) AS measurement_date, 
+						CASE analyte_concepts.analyte
+							{value_cases}
+						END AS value_as_number
+					FROM {dataset_project}.{dataset}.measurement AS measure
+					INNER JOIN analyte_concepts
+					ON measure.measurement_concept_id = analyte_concepts.concept_id
+					WHERE 
+						({filters})
+						AND CAST(measure.measurement_DATETIME AS DATE) > COALESCE(
+							(SELECT MAX(measurement_date) FROM `{sepsis_daily_measurement}`), 
+							DATE '0001-01-01'
+						)
+				)
+				SELECT 
+					person_id, 
+					analyte, 
+					measurement_date, 
+					MIN(value_as_number) AS min_value, 
+					MAX(value_as_number) AS max_value, 
+					SUM(value_as_number) AS sum_value, 
+					COUNT(value_as_number) AS value_count
+				FROM analyte_values
+				GROUP BY person_id, analyte, measurement_date
+				'''
+		if not format_query:
+			pass
+		else:
+			query = query.format_map(
+						{**self.config_dict,
+						 **{"values_query":self.get_values_query(),
+							"value_cases":self.get_value_cases(),
+							"filters":self.get_filters()}})
+		
+		if self.config_dict['print_query']:
+			print(query)
+		
+		return query
+	
+	def get_person_bounds_query(self):
+		return ''
+
+class RespiratoryFlowsheetExtract(Component):
+	'''
+	Class to extract the FiO2, SpO2 and vent mode rows used by the respiratory components in a single scan of the flowsheet table.
+	Writes a typed (person_id, observation_datetime, measure, value_as_number, value_as_string) table.
+	FiO2 is normalized to a fraction.
+	'''
+	table_key = 'sepsis_resp_flowsheet'
+	flowsheet_display_names = ['FIO2 (%)', 'FIO2 %', 'OXYGEN SATURATION', 'SPO2 - %', 'VENT MODE', 'VENTILATION MODE']
+	partition_column = None
+	cluster_columns = ['measure', 'person_id']
+	
+	def __init__(self, *args, **kwargs):
+		Component.__init__(self, *args, **kwargs)
+	
+	def get_input_tables(self):
+		tables = [self.get_flowsheet_table()]
+		if self.config_dict['cohort_scoped_extracts']:
+			tables.append(self.config_dict['admission_rollup'])
+		return tables
+	
+	def get_component_query(self, format_query=True):
+		query = '''
+				CREATE OR REPLACE TABLE `{sepsis_resp_flowsheet}` {table_options_str} AS
+				WITH {person_bounds_query}flowsheet AS (
+					SELECT 
+						flowsheet_source.person_id, 
+						observation_datetime, 
+						meas_value, 
+						SAFE_CAST(meas_value as float64) AS numeric_value,
+						UPPER(display_name) AS disp_name,
+						UPPER(source_display_name) AS source_disp_name
+					FROM {dataset_project}.{rs_dataset}.{ext_flwsht_table} AS flowsheet_source
+					{person_bounds_join}
+					WHERE meas_value IS NOT NULL
+				),
+				flowsheet_measures AS (
+					SELECT 
+						*,
+						CASE
+							WHEN disp_name = 'FIO2 (%)' OR (disp_name = 'FIO2 %' AND source_disp_name = 'RN CLINICAL SCREENING')
+								THEN 'fio2'
+							WHEN (disp_name = 'OXYGEN SATURATION' AND source_disp_name = 'SPO2') 
+								OR (disp_name LIKE 'SPO2 - %' AND source_disp_name = 'DEVICES TESTING TEMPLATE')
+								THEN 'spo2'
+							WHEN (disp_name = 'VENT MODE' OR disp_name = 'VENTILATION MODE') AND meas_value <> 'STANDBY' AND meas_value <> 'MONITOR'
+								THEN 'vent_mode'
+						END AS measure
+					FROM flowsheet
+				)
+				SELECT 
+					person_id, 
+					observation_datetime, 
+					measure,
+					CASE 
+						WHEN measure = 'fio2' AND numeric_value > 1 THEN numeric_value / 100
+						ELSE numeric_value
+					END AS value_as_number,
+					meas_value AS value_as_string
+				FROM flowsheet_measures
+				WHERE measure IS NOT NULL
+				'''
+		if not format_query:
+			pass
+		else:
+			query = query.format_map({
+				**self.config_dict,
+				**{"person_bounds_query":self.get_person_bounds_query(),
+				   "person_bounds_join":self.get_person_bounds_join('flowsheet_source.person_id', 'flowsheet_source.observation_datetime')}
+			})
+		
+		if self.config_dict['print_query']:
+			print(query)
+		
+		return query
+
+class DrugExposureExtract(Component):
+	'''
+	Class to extract the vasopressor and systemic antibiotic exposures used by the components in a single scan of the drug_exposure table.
+	Writes a narrow (person_id, drug, drug_concept_id, drug_type, drug_exposure_start_DATETIME, drug_exposure_end_DATETIME) table.
+	'''
+	table_key = 'sepsis_drug'
+	partition_column = None
+	cluster_columns = ['drug', 'person_id']
+	# Ancestor concept of each extracted drug; descendants are included
+	drugs = {**VasopressorComponent.vasopressors, 'systemic_abx': 21602796}
+	
+	def __init__(self, *args, **kwargs):
+		Component.__init__(self, *args, **kwargs)
+	
+	def get_input_tables(self):
+		return [self.config_dict['admission_rollup']] if self.config_dict['cohort_scoped_extracts'] else []
+	
+	def get_component_query(self, format_query=True):
+		query = '''
+				CREATE OR REPLACE TABLE `{sepsis_drug}` {table_options_str} AS
+				WITH {person_bounds_query}drug_ancestors AS (
+					SELECT * FROM UNNEST([
+						{drug_structs}
+					])
+				),
+				drug_list AS (
+					SELECT 
+						drug, 
+						descendant_concept_id AS concept_id
+					FROM {dataset_project}.{dataset}.concept_ancestor
+					INNER JOIN drug_ancestors
+					USING (ancestor_concept_id)
+				)
+				SELECT 
+					drug_exposure.person_id, 
+					drug_list.drug, 
+					drug_exposure.drug_concept_id, 
+					concept.concept_name AS drug_type, 
+					drug_exposure.drug_exposure_start_DATETIME, 
+					drug_exposure.drug_exposure_end_DATETIME
+				FROM {dataset_project}.{dataset}.drug_exposure AS drug_exposure
+				INNER JOIN drug_list
+				ON drug_exposure.drug_concept_id = drug_list.concept_id
+				INNER JOIN {dataset_project}.{dataset}.concept AS concept
+				ON drug_exposure.drug_concept_id = concept.concept_id
+				{person_bounds_join}
+				'''
+		if not format_query:
+			pass
+		else:
+			query = query.format_map({
+				**self.config_dict,
+				**{"drug_structs":',\n\t\t\t\t\t\t'.join(
+					f"STRUCT('{drug}' AS drug, {concept_id} AS ancestor_concept_id)" for drug, concept_id in self.drugs.items()
+				   ),
+				   "person_bounds_query":self.get_person_bounds_query(),
+				   "person_bounds_join":self.get_person_bounds_join(
+					   'drug_exposure.person_id', 
+					   'drug_exposure.drug_exposure_start_DATETIME', 
+					   'drug_exposure.drug_exposure_end_DATETIME'
+				   )}
+			})
+		
+		if self.config_dict['print_query']:
+			print(query)
+		
+		return query
+
+class ObservationBoundsExtract(Component):
+	'''
+	Class to compute the first and last charted flowsheet times of each person on each admission day of the cohort.
+	Observations at exactly midnight are left out, as they are date-only charting.
+	The urine component scales its partial admission and discharge days with these times instead of joining its rows to the flowsheet table.
+	'''
+	table_key = 'sepsis_obs_bounds'
+	flowsheet_admission_days = True
+	partition_column = None
+	cluster_columns = ['person_id']
+	
+	def __init__(self, *args, **kwargs):
+		Component.__init__(self, *args, **kwargs)
+	
+	def get_input_tables(self):
+		return [self.get_flowsheet_table(), self.config_dict['admission_rollup']]
+	
+	def get_component_query(self, format_query=True):
+		query = '''
+				CREATE OR REPLACE TABLE `{sepsis_obs_bounds}` {table_options_str} AS
+				WITH admission_days AS (
+					SELECT DISTINCT 
+						person_id, 
+						CAST(admit_date AS DATE) AS admit_day
+					FROM `{admission_rollup}`
+				)
+				SELECT 
+					flowsheet.person_id, 
+					admission_days.admit_day AS observation_date, 
+					MIN(observation_datetime) AS min_observation_datetime, 
+					MAX(observation_datetime) AS max_observation_datetime
+				FROM {dataset_project}.{rs_dataset}.{ext_flwsht_table} AS flowsheet
+				INNER JOIN admission_days 
+				ON flowsheet.person_id = admission_days.person_id 
+				AND CAST(flowsheet.observation_datetime AS DATE) = admission_days.admit_day
+				WHERE observation_datetime <> DATETIME_TRUNC(observation_datetime, DAY)
+				GROUP BY flowsheet.person_id, admission_days.admit_day
+				'''
+		if not format_query:
+			pass
+		else:
+			query = query.format_map(self.config_dict)
+		
+		if self.config_dict['print_query']:
+			print(query)
+		
+		return query
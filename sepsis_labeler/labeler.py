@@ -1,28 +1,69 @@
 import os
+import json
+import re
+import warnings
 import pandas as pd
+from functools import partial
+from google.cloud import bigquery
 from prediction_utils.extraction_utils.database import BQDatabase
 
 from sepsis_labeler.sofa import SOFAScore 
 from sepsis_labeler.cohort import SepsisAdmissionCohort
 from sepsis_labeler.component import * 
+from sepsis_labeler.component_base import FusedComponent
+from sepsis_labeler.event_extract import MeasurementExtract, DailyMeasurementStore, RespiratoryFlowsheetExtract, DrugExposureExtract, ObservationBoundsExtract
 from sepsis_labeler.starr_flowsheet_extract import STARRFlowsheetExtract 
+from sepsis_labeler.scheduler import Stage, DAGScheduler
+from sepsis_labeler.stage_cache import StageCache
+from sepsis_labeler.source_changes import SourceChangeTracker
+from sepsis_labeler.partitioning import PartitioningCheck
+from sepsis_labeler.plan_analyzer import QueryPlanAnalyzer
 
 class SepsisLabeler:
+	job_stats_columns = [
+		'stage', 'component', 'job_id', 'wall_seconds', 'slot_millis', 'bytes_processed', 
+		'bytes_billed', 'shuffle_bytes', 'rows_written', 'cache_hit'
+	]
 	
-	def __init__(self, *args, **kwargs):
+	def __init__(self, *args, db=None, **kwargs):
 		self.config_dict = self.get_config_dict(**kwargs)
-		self.db = BQDatabase(**self.config_dict)
 		self.verbose = self.config_dict['verbose']
+		# One client is shared by every component, extract, cohort and SOFA object of the run
+		self.db = db if db is not None else BQDatabase(**self.config_dict)
+		self.cohort = None if self.config_dict['pre_existing_cohort'] else SepsisAdmissionCohort(db=self.db, **self.config_dict)
+		self.partitioning = PartitioningCheck(self.db)
+		self.fingerprints = {}
+		self.job_stats = []
+		self.stage_cache = StageCache(
+			self.db, self.config_dict['sepsis_stage_cache'], self.verbose, sources=self.get_source_tables()
+		) if self.config_dict['stage_cache'] else None
 	
 	def create_labels(self):
 		if self.verbose:
 			print('Running SEPSIS labeler...')
+		if self.has_byte_budgets():
+			self.check_byte_budgets()
+		if self.config_dict['incremental']:
+			return self.create_labels_incremental()
+		if self.config_dict['single_script']:
+			return self.create_labels_script()
+		if self.uses_stages():
+			return self.create_labels_dag()
+		self.check_partitioning()
 		# Extract flowsheet values into their own table if applicable
-		self.extract_flowsheets()
+		if not self.config_dict['targeted_flowsheet_extract']:
+			self.extract_flowsheets()
 		
 		# Create cohort if pre-existing cohort is not defined
 		self.create_cohort()
 		
+		# A targeted flowsheet extract only keeps the rows of cohort persons
+		if self.config_dict['targeted_flowsheet_extract']:
+			self.extract_flowsheets()
+		
+		# Extract shared event tables read by the components if applicable
+		self.create_event_extracts()
+		
 		# Create component tables
 		self.create_components()
 		
@@ -38,11 +79,719 @@ class SepsisLabeler:
 			print('Returning labels as dataframe...')
 			return df
 	
+	def uses_stages(self):
+		'''
+		Returns whether the run needs the stage runner, which the cache, byte budgets and job statistics are attached to.
+		'''
+		return bool(
+			self.config_dict['dag_scheduler'] or self.config_dict['stage_cache'] or 
+			self.has_byte_budgets() or self.config_dict['collect_job_stats']
+		)
+	
+	def check_partitioning(self):
+		'''
+		Recreates the tables the run replaces with a different partitioning spec before any job starts, for runs outside the stage runner, 
+		which checks each stage just before it runs instead.
+		'''
+		for stage in self.get_stages():
+			if stage.run is None:
+				self.partitioning.check(stage.get_query())
+	
+	def create_labels_dag(self):
+		'''
+		Runs every stage of the pipeline as soon as the tables it reads exist, instead of in fixed stage order.
+		Without dag_scheduler, the stages run one at a time.
+		'''
+		results = self.run_stages(self.get_stages())
+		df = results.get('labelled_cohort')
+		if self.verbose:
+			print('Finished!')
+		if df is not None:
+			print('Returning labels as dataframe...')
+			return df
+	
+	def run_stages(self, stages):
+		max_workers = self.config_dict['max_workers'] if self.config_dict['dag_scheduler'] else 1
+		return DAGScheduler(stages, max_workers=max_workers, verbose=self.verbose).run(self.run_stage)
+	
+	def create_labels_incremental(self):
+		'''
+		Relabels only the admissions that are new, were discharged within incremental_lookback_days of the last run's watermark, 
+		or whose visits or events changed since the last run.
+		Events are only read from the source partitions modified since the last run, and the event extracts only for the changed admissions. 
+		The cohort is rebuilt only if the visit or person tables changed.
+		Components and SOFA scores are computed into _delta tables for those admissions and merged into the existing tables in one transaction.
+		The first run, with no watermark recorded, labels the full cohort.
+		'''
+		if self.config_dict['replace_cohort'] or not self.config_dict['save_to_database']:
+			raise ValueError('Incremental labeling requires replace_cohort=False and save_to_database=True')
+		if self.config_dict['extract_flowsheet'] and not self.config_dict['incremental_flowsheet']:
+			raise ValueError('Incremental labeling requires incremental_flowsheet=True when extract_flowsheet is set, so flowsheets are not extracted in full on every run')
+		started_at = self.get_current_timestamp()
+		last_run = self.get_watermark()
+		if last_run is None:
+			if self.verbose:
+				print('No watermark found, labeling the full cohort...')
+		elif self.verbose:
+			print(f'Labeling admissions changed since {last_run.recorded_at}...')
+		stages, merge = self.get_incremental_stages(last_run)
+		self.run_stages(stages)
+		if merge is not None:
+			if self.verbose:
+				print('Merging changed admissions into existing tables...')
+			self.run_stage(merge)
+		self.db.execute_sql(self.get_record_watermark_query(started_at))
+		if self.verbose:
+			print('Finished!')
+	
+	def get_incremental_stages(self, last_run):
+		'''
+		Returns the stages of an incremental run and the stage merging its _delta tables, or None on the first run, 
+		which labels the full cohort and records the event digests of every admission.
+		The admission_events and merge_delta stages can be given a budget in stage_max_bytes_billed like any other.
+		'''
+		if last_run is None:
+			changes = SourceChangeTracker(self.db)
+			stages = self.get_stages()
+			stages.append(Stage(
+				'admission_events',
+				partial(self.get_admission_events_query, self.config_dict['admission_events'], changes),
+				reads=[self.config_dict['admission_rollup']] + list(self.get_event_source_tables().values()),
+				writes=[self.config_dict['admission_events']],
+				component='SepsisLabeler'
+			))
+			return stages, None
+		changes = SourceChangeTracker(self.db, since=last_run.recorded_at)
+		delta = self.get_delta_labeler()
+		shared_stages = ['extract_flowsheets', 'daily_measurement_store']
+		if any(changes.has_changed(table) for table in self.get_cohort_source_tables()):
+			shared_stages.append('create_cohort')
+		stages = [stage for stage in self.get_stages() if stage.name in shared_stages]
+		stages.append(Stage(
+			'admission_events',
+			partial(self.get_admission_events_query, self.get_current_events_table(), changes),
+			reads=[self.config_dict['admission_rollup']] + list(self.get_event_source_tables().values()),
+			writes=[self.get_current_events_table()],
+			component='SepsisLabeler'
+		))
+		stages.append(Stage(
+			'admission_delta',
+			partial(self.get_admission_delta_query, last_run.watermark, changes),
+			reads=[self.config_dict['admission_rollup'], self.get_labelled_cohort_table(), self.get_current_events_table()],
+			writes=[self.config_dict['admission_delta']],
+			component='SepsisLabeler'
+		))
+		stages.extend(stage for stage in delta.get_stages() if stage.name not in shared_stages + ['create_cohort'])
+		# The merge rewrites tables the other stages read, so it runs on its own once they all finished
+		merge = Stage(
+			'merge_delta', 
+			partial(self.get_merge_query, delta, changes), 
+			reads=[table for stage in stages for table in stage.writes], 
+			component='SepsisLabeler'
+		)
+		return stages, merge
+	
+	def get_planned_stages(self):
+		'''
+		Returns the stages a run of create_labels would execute, for estimate.
+		'''
+		if not self.config_dict['incremental']:
+			return self.get_stages()
+		stages, merge = self.get_incremental_stages(self.get_watermark())
+		return stages if merge is None else stages + [merge]
+	
+	def create_labels_script(self):
+		'''
+		Submits the whole pipeline as a single BigQuery script job.
+		'''
+		script = self.get_script()
+		self.partitioning.check(script)
+		if self.verbose:
+			print('Running pipeline as a single script...')
+		job_config = None
+		if self.config_dict['max_bytes_billed']:
+			job_config = bigquery.QueryJobConfig(maximum_bytes_billed=self.config_dict['max_bytes_billed'])
+		job = self.db.client.query(script, job_config=job_config)
+		result = job.result()
+		if self.config_dict['collect_job_stats']:
+			self.job_stats.append(self.get_job_stats(Stage('single_script', script, component='SepsisLabeler'), job))
+		df = None if self.config_dict['save_to_database'] else result.to_dataframe()
+		if self.verbose:
+			print('Finished!')
+		if df is not None:
+			print('Returning labels as dataframe...')
+			return df
+	
+	def get_script(self):
+		'''
+		Compiles every stage of the pipeline, in dependency order, into one multi-statement script.
+		Intermediate tables are session temp tables, except the keys listed in persist_tables and the labelled cohort.
+		Without save_to_database, the script ends in the labelled cohort SELECT, so the job returns the labels.
+		An incremental flowsheet refresh reads its watermark and date slices between jobs, so it cannot be compiled into the script.
+		'''
+		if self.config_dict['extract_flowsheet'] and self.config_dict['incremental_flowsheet']:
+			raise ValueError('single_script does not support incremental_flowsheet, extract the flowsheets in a separate run or disable one of them')
+		script_labeler = self.get_script_labeler()
+		scheduler = DAGScheduler(script_labeler.get_stages())
+		statements = []
+		for name in scheduler.order:
+			if name == 'labelled_cohort':
+				query = script_labeler.get_labelled_cohort_query(cohort_name=self.get_labelled_cohort_table())
+			else:
+				query = scheduler.stages[name].get_query()
+			# Tables renamed to a bare temp table name are the ones not persisted
+			query = re.sub(r'CREATE OR REPLACE TABLE\s+(`?)(\w+)\1(?=\s)', r'CREATE OR REPLACE TEMP TABLE \1\2\1', query)
+			statements.append(query.strip().rstrip(';') + ';')
+		return '\n'.join(statements)
+	
+	def get_script_labeler(self):
+		'''
+		Returns a labeler whose intermediate tables are named as temp tables.
+		'''
+		keys = self.get_extract_keys() + self.get_delta_keys()
+		if not self.config_dict['pre_existing_cohort']:
+			keys.append('admission_rollup')
+		script_labeler = SepsisLabeler(db=self.db, **{
+			**self.config_dict,
+			**{key: self.config_dict[key].split('.')[-1] for key in keys if key not in self.config_dict['persist_tables']},
+			'single_script': False,
+			'stage_cache': False,
+		})
+		return script_labeler
+	
+	def get_delta_labeler(self):
+		'''
+		Returns a labeler writing every per-admission table of the pipeline to a _delta table, driven by the changed admissions only.
+		Its event extracts are _delta tables scoped to the changed admissions too. The daily measurement store is shared, since it refreshes itself.
+		'''
+		delta = SepsisLabeler(db=self.db, **{
+			**self.config_dict,
+			**{key: self.config_dict[key] + '_delta' for key in self.get_delta_keys() + self.get_extract_keys()},
+			'admission_rollup': self.config_dict['admission_delta'],
+			# The delta cohort is only built once the run started, and has the admit_date type of the cohort
+			'admit_date_type': self.get_admit_date_type(),
+			'pre_existing_cohort': True,
+			'extract_flowsheet': False,
+			'cohort_scoped_extracts': True,
+			'incremental': False,
+			'stage_cache': False,
+		})
+		return delta
+	
+	def get_delta_keys(self):
+		return ['suspected_infection', 'sepsis_vasopressor', 'sepsis_sofa', 'sepsis_difference'] + SOFAScore.component_keys
+	
+	def get_extract_keys(self):
+		return ['sepsis_measurement', 'sepsis_resp_flowsheet', 'sepsis_drug', 'sepsis_obs_bounds']
+	
+	def get_current_timestamp(self):
+		return list(self.db.client.query('SELECT CURRENT_TIMESTAMP() AS now').result())[0].now
+	
+	def get_watermark(self):
+		'''
+		Returns the watermark and recorded_at of the last incremental run, or None if there was none.
+		'''
+		self.db.execute_sql(f'''
+				CREATE TABLE IF NOT EXISTS `{self.config_dict['sepsis_watermark']}` (
+					watermark DATETIME,
+					recorded_at TIMESTAMP
+				)
+				''')
+		query = f'''
+				SELECT watermark, recorded_at
+				FROM `{self.config_dict['sepsis_watermark']}`
+				ORDER BY recorded_at DESC
+				LIMIT 1
+				'''
+		rows = list(self.db.client.query(query).result())
+		return rows[0] if rows else None
+	
+	def get_record_watermark_query(self, started_at):
+		'''
+		The watermark is the latest discharge in the cohort, since the source dates are shifted and the wall clock does not apply.
+		recorded_at is the start of the run, so source changes made while it ran are picked up by the next one.
+		'''
+		query = '''
+				INSERT INTO `{sepsis_watermark}` (watermark, recorded_at)
+				SELECT CAST(MAX(discharge_date) AS DATETIME), TIMESTAMP '{started_at}'
+				FROM `{admission_rollup}`
+				'''
+		return query.format_map({**self.config_dict, 'started_at': started_at.isoformat()})
+	
+	def get_current_events_table(self):
+		return self.config_dict['admission_events'] + '_current'
+	
+	def get_source_tables(self):
+		'''
+		Returns the OMOP tables the pipeline reads. No stage writes them, so they are not listed in the reads of the stages.
+		'''
+		return [
+			'{dataset_project}.{dataset}.{table}'.format(table=table, **self.config_dict)
+			for table in ['person', 'visit_occurrence', 'measurement', 'drug_exposure', 'observation', 'concept', 'concept_ancestor']
+		]
+	
+	def get_cohort_source_tables(self):
+		return [
+			'{dataset_project}.{dataset}.person'.format_map(self.config_dict),
+			'{dataset_project}.{dataset}.visit_occurrence'.format_map(self.config_dict),
+		]
+	
+	def get_event_source_tables(self):
+		return {
+			'measurement': '{dataset_project}.{dataset}.measurement'.format_map(self.config_dict),
+			'drug_exposure': '{dataset_project}.{dataset}.drug_exposure'.format_map(self.config_dict),
+			'flowsheet': '{dataset_project}.{rs_dataset}.{ext_flwsht_table}'.format_map(self.config_dict),
+		}
+	
+	def get_admission_events_query(self, table, changes):
+		'''
+		Summarizes, for each admission and source partition changed since the last run, the measurement, drug and flowsheet events 
+		any component window can reach. The digest XORs a fingerprint of the columns the components read from each event, 
+		so late, corrected and deleted events all change it, whatever their timestamps.
+		'''
+		query = '''
+				CREATE OR REPLACE TABLE `{table}` AS
+				WITH events AS (
+					SELECT 
+						'measurement' AS source, 
+						{measurement_partition_id} AS partition_id, 
+						person_id, 
+						measurement_DATETIME AS event_start, 
+						measurement_DATETIME AS event_end, 
+						FARM_FINGERPRINT(TO_JSON_STRING(STRUCT(person_id, measurement_concept_id, measurement_DATETIME, value_as_number, unit_concept_id))) AS event_fingerprint
+					FROM `{measurement}`
+					WHERE ({measurement_filter}) AND person_id IN (SELECT person_id FROM `{admission_rollup}`)
+					UNION ALL
+					SELECT 
+						'drug_exposure', 
+						{drug_exposure_partition_id}, 
+						person_id, 
+						drug_exposure_start_DATETIME, 
+						COALESCE(drug_exposure_end_DATETIME, drug_exposure_start_DATETIME), 
+						FARM_FINGERPRINT(TO_JSON_STRING(STRUCT(person_id, drug_concept_id, drug_exposure_start_DATETIME, drug_exposure_end_DATETIME)))
+					FROM `{drug_exposure}`
+					WHERE ({drug_exposure_filter}) AND person_id IN (SELECT person_id FROM `{admission_rollup}`)
+					UNION ALL
+					SELECT 
+						'flowsheet', 
+						{flowsheet_partition_id}, 
+						person_id, 
+						observation_datetime, 
+						observation_datetime, 
+						FARM_FINGERPRINT(TO_JSON_STRING(STRUCT(person_id, display_name, observation_datetime, meas_value, units)))
+					FROM `{flowsheet}`
+					WHERE ({flowsheet_filter}) AND person_id IN (SELECT person_id FROM `{admission_rollup}`)
+				)
+				SELECT 
+					adm.person_id, 
+					adm.admit_date, 
+					events.source, 
+					events.partition_id, 
+					COUNT(*) AS event_count, 
+					BIT_XOR(events.event_fingerprint) AS event_digest
+				FROM `{admission_rollup}` AS adm
+				INNER JOIN events
+				ON events.person_id = adm.person_id AND 
+				   events.event_start <= DATETIME_ADD(DATETIME_TRUNC(CAST(adm.discharge_date AS DATETIME), DAY), INTERVAL {extract_lookahead_days} DAY) AND 
+				   events.event_end >= DATETIME_SUB(DATETIME_TRUNC(CAST(adm.admit_date AS DATETIME), DAY), INTERVAL {extract_lookback_days} DAY)
+				GROUP BY adm.person_id, adm.admit_date, events.source, events.partition_id
+				'''
+		sources = self.get_event_source_tables()
+		format_dict = {**self.config_dict, **sources, 'table': table}
+		for source, source_table in sources.items():
+			partition_id, row_filter, _ = changes.get_changes(source_table)
+			format_dict[f'{source}_partition_id'] = partition_id
+			format_dict[f'{source}_filter'] = row_filter
+		return query.format_map(format_dict)
+	
+	def get_changed_partitions_filter(self, changes):
+		'''
+		Returns the filter on the recorded event digests of the source partitions changed since the last run.
+		'''
+		terms = []
+		for source, source_table in self.get_event_source_tables().items():
+			_, _, partition_ids = changes.get_changes(source_table)
+			if partition_ids is None:
+				terms.append(f"source = '{source}'")
+			elif partition_ids:
+				terms.append(f"(source = '{source}' AND partition_id IN ({', '.join(repr(str(partition_id)) for partition_id in partition_ids)}))")
+		return ' OR '.join(terms) or 'FALSE'
+	
+	def get_admission_delta_query(self, watermark, changes):
+		'''
+		Selects the admissions that are not labelled yet, were discharged within incremental_lookback_days of the watermark, 
+		changed their discharge, or whose event digest in a changed source partition differs from the one recorded by the last run.
+		A rebuilt cohort draws new prediction_ids, so the ids of admissions already labelled are first copied back into it.
+		'''
+		query = '''
+				{reuse_prediction_id_query}
+				CREATE TABLE IF NOT EXISTS `{admission_events}` AS
+				SELECT * FROM `{current_events}` LIMIT 0;
+				CREATE OR REPLACE TABLE `{admission_delta}` AS
+				WITH changed_events AS (
+					SELECT person_id, admit_date
+					FROM `{current_events}` AS cur
+					FULL OUTER JOIN (
+						SELECT * 
+						FROM `{admission_events}` 
+						WHERE {changed_partitions}
+					) AS prev
+					USING (person_id, admit_date, source, partition_id)
+					WHERE cur.event_digest IS DISTINCT FROM prev.event_digest OR 
+						  cur.event_count IS DISTINCT FROM prev.event_count
+				)
+				SELECT adm.*
+				FROM `{admission_rollup}` AS adm
+				LEFT JOIN `{labelled_cohort}` AS lab
+				ON lab.person_id = adm.person_id AND CAST(lab.admit_date AS DATE) = CAST(adm.admit_date AS DATE)
+				WHERE lab.person_id IS NULL OR 
+					  lab.discharge_date IS DISTINCT FROM adm.discharge_date OR
+					  CAST(adm.discharge_date AS DATE) >= DATE_SUB(CAST(DATETIME '{watermark}' AS DATE), INTERVAL {incremental_lookback_days} DAY) OR
+					  EXISTS (
+						  SELECT 1 
+						  FROM changed_events 
+						  WHERE changed_events.person_id = adm.person_id AND changed_events.admit_date = adm.admit_date
+					  )
+				'''
+		return query.format_map({
+			**self.config_dict, 
+			'labelled_cohort': self.get_labelled_cohort_table(), 
+			'current_events': self.get_current_events_table(),
+			'changed_partitions': self.get_changed_partitions_filter(changes),
+			'reuse_prediction_id_query': self.get_reuse_prediction_id_query(),
+			'watermark': watermark
+		})
+	
+	def get_reuse_prediction_id_query(self):
+		if self.config_dict['pre_existing_cohort']:
+			return ''
+		query = '''
+				UPDATE `{admission_rollup}` AS adm
+				SET prediction_id = lab.prediction_id
+				FROM `{labelled_cohort}` AS lab
+				WHERE lab.person_id = adm.person_id AND lab.admit_date = adm.admit_date;
+				'''
+		return query.format_map({**self.config_dict, 'labelled_cohort': self.get_labelled_cohort_table()})
+	
+	def get_merge_query(self, delta, changes):
+		'''
+		Replaces the rows of the changed admissions, and deletes those of admissions no longer in the cohort, keyed on (person_id, admit_date). 
+		Also replaces the recorded event digests of the source partitions that changed.
+		'''
+		tables = {delta.get_labelled_cohort_table(): self.get_labelled_cohort_table()}
+		for key in self.get_delta_keys():
+			tables[delta.config_dict[key]] = self.config_dict[key]
+			tables[delta.config_dict[key] + '_prior'] = self.config_dict[key] + '_prior'
+		written = {table for stage in delta.get_stages() for table in stage.writes}
+		statements = [
+			f'''
+				DELETE FROM `{tables[table]}` AS t
+				WHERE EXISTS (
+						  SELECT 1 FROM `{self.config_dict['admission_delta']}` AS d
+						  WHERE d.person_id = t.person_id AND CAST(d.admit_date AS DATE) = CAST(t.admit_date AS DATE)
+					  ) OR 
+					  NOT EXISTS (
+						  SELECT 1 FROM `{self.config_dict['admission_rollup']}` AS a
+						  WHERE a.person_id = t.person_id AND CAST(a.admit_date AS DATE) = CAST(t.admit_date AS DATE)
+					  );
+				INSERT INTO `{tables[table]}`
+				SELECT * FROM `{table}`;'''
+			for table in tables if table in written
+		]
+		statements.append(f'''
+				DELETE FROM `{self.config_dict['admission_events']}` AS t
+				WHERE ({self.get_changed_partitions_filter(changes)}) OR 
+					  NOT EXISTS (
+						  SELECT 1 FROM `{self.config_dict['admission_rollup']}` AS a
+						  WHERE a.person_id = t.person_id AND a.admit_date = t.admit_date
+					  );
+				INSERT INTO `{self.config_dict['admission_events']}`
+				SELECT * FROM `{self.get_current_events_table()}`;''')
+		return 'BEGIN TRANSACTION;' + ''.join(statements) + '\nCOMMIT TRANSACTION;'
+	
+	def get_stages(self):
+		'''
+		Returns every job of the pipeline as a Stage declaring the tables it reads and writes.
+		'''
+		stages = []
+		if self.config_dict['extract_flowsheet']:
+			extract = self.get_flowsheet_extract()
+			stages.append(Stage(
+				'extract_flowsheets', 
+				extract.get_extract_flowsheets_query, 
+				reads=extract.get_input_tables(), 
+				writes=extract.get_output_tables(), 
+				# An incremental refresh runs its own date slices
+				run=extract.create_cohort_table if self.config_dict['incremental_flowsheet'] else None,
+				estimate=extract.get_refresh_estimate_queries if self.config_dict['incremental_flowsheet'] else None,
+				component='STARRFlowsheetExtract'
+			))
+		if not self.config_dict['pre_existing_cohort']:
+			stages.append(Stage(
+				'create_cohort', 
+				self.cohort.get_create_query, 
+				writes=self.cohort.get_output_tables(), 
+				component='SepsisAdmissionCohort'
+			))
+		stages.extend(self.get_component_stage(name, extract) for name, extract in self.get_event_extracts())
+		stages.append(self.get_component_stage('suspected_infection', SuspectedInfectionComponent(db=self.db, **self.config_dict)))
+		stages.extend(self.get_component_stage(name, component) for name, component in self.get_component_jobs())
+		sofa = SOFAScore(db=self.db, **self.config_dict)
+		stages.append(Stage(
+			'sofa', 
+			sofa.get_score_query, 
+			reads=sofa.get_score_input_tables(), 
+			writes=[sofa.get_score_output_table()],
+			component='SOFAScore'
+		))
+		stages.append(Stage(
+			'sofa_prior', 
+			partial(sofa.get_score_query, prior=True), 
+			reads=sofa.get_score_input_tables(prior=True), 
+			writes=[sofa.get_score_output_table(prior=True)],
+			component='SOFAScore'
+		))
+		stages.append(Stage(
+			'sofa_difference', 
+			sofa.get_difference_query, 
+			reads=sofa.get_difference_input_tables(), 
+			writes=[self.config_dict['sepsis_difference']],
+			component='SOFAScore'
+		))
+		# Rewriting a pre-existing cohort in place is not declared as a write, so it is still read as an input
+		labelled_cohort = self.get_labelled_cohort_table()
+		stages.append(Stage(
+			'labelled_cohort',
+			self.get_labelled_cohort_query,
+			reads=[self.config_dict['admission_rollup'], self.config_dict['sepsis_difference']],
+			writes=[labelled_cohort] if self.config_dict['save_to_database'] and labelled_cohort != self.config_dict['admission_rollup'] else [],
+			run=None if self.config_dict['save_to_database'] else self.read_labelled_cohort,
+			estimate=None if self.config_dict['save_to_database'] else lambda: [self.get_labelled_cohort_query()],
+			component='SepsisLabeler'
+		))
+		return stages
+	
+	def get_component_stage(self, name, component):
+		return Stage(
+			name, 
+			component.get_component_query, 
+			reads=component.get_input_tables(), 
+			writes=component.get_output_tables(),
+			component=getattr(component, 'component_class', type(component)).__name__
+		)
+	
+	def run_stage(self, stage):
+		if stage.run is not None:
+			if self.verbose:
+				print(f'Running stage {stage.name}...')
+			return stage.run()
+		query = stage.get_query()
+		if self.is_cached(stage, query):
+			return
+		self.partitioning.check(query)
+		if self.verbose:
+			print(f'Running stage {stage.name}...')
+		job_config = self.get_job_config(stage)
+		if job_config is None and not self.config_dict['collect_job_stats']:
+			self.db.execute_sql(query)
+			job = None
+		else:
+			job = self.db.client.query(query, job_config=job_config)
+			job.result()
+		self.complete_stage(stage, job)
+	
+	def estimate(self):
+		'''
+		Dry-runs every stage query and returns a dataframe of the bytes each would process, in pipeline order.
+		Stages that cannot be dry-run, e.g. because the tables they read do not exist yet, are reported with their error instead.
+		Stages with a run function are estimated from the queries their estimate function returns, or reported as skipped without one.
+		'''
+		scheduler = DAGScheduler(self.get_planned_stages())
+		rows = []
+		for name in scheduler.order:
+			stage = scheduler.stages[name]
+			row = {'stage': name, 'bytes_processed': None, 'max_bytes_billed': self.get_max_bytes_billed(name), 'error': None}
+			try:
+				if stage.estimate is not None:
+					queries = stage.estimate()
+				elif stage.run is None:
+					queries = [stage.get_query()]
+				else:
+					raise ValueError('Skipped, the stage runs a function that cannot be dry-run')
+				row['bytes_processed'] = sum(
+					self.db.client.query(query, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)).total_bytes_processed
+					for query in queries
+				)
+			except Exception as e:
+				row['error'] = str(e)
+			rows.append(row)
+		df = pd.DataFrame(rows)
+		if self.verbose:
+			print(f"Estimated {df['bytes_processed'].sum() / 1e9:.2f} GB processed over {df['error'].isna().sum()} of {len(df)} stages")
+		return df
+	
+	def has_byte_budgets(self):
+		return bool(self.config_dict['max_bytes_billed'] or self.config_dict['stage_max_bytes_billed'])
+	
+	def check_byte_budgets(self):
+		'''
+		Raises before any job starts if the dry run of a stage exceeds its max_bytes_billed.
+		Stages with a budget that cannot be dry-run, typically because a fresh run has not built their inputs yet, 
+		are warned about, since only the maximum_bytes_billed of their job will stop them. With strict_byte_budgets they raise instead.
+		'''
+		df = self.estimate()
+		over = [
+			f"{row['stage']}: {int(row['bytes_processed'])} bytes > {int(row['max_bytes_billed'])}"
+			for _, row in df.iterrows()
+			if pd.isna(row['error']) and pd.notna(row['max_bytes_billed']) and row['bytes_processed'] > row['max_bytes_billed']
+		]
+		if over:
+			raise ValueError('Stages over their max_bytes_billed:\n' + '\n'.join(over))
+		unestimated = [
+			f"{row['stage']}: {row['error']}"
+			for _, row in df.iterrows()
+			if pd.notna(row['error']) and pd.notna(row['max_bytes_billed'])
+		]
+		if unestimated:
+			message = f'{len(unestimated)} of {len(df)} stages could not be estimated against their max_bytes_billed:\n' + '\n'.join(unestimated)
+			if self.config_dict['strict_byte_budgets']:
+				raise ValueError(message)
+			warnings.warn(message + '\nTheir jobs are still capped by maximum_bytes_billed when they run.')
+	
+	def get_max_bytes_billed(self, name):
+		return self.config_dict['stage_max_bytes_billed'].get(name, self.config_dict['max_bytes_billed'])
+	
+	def get_job_config(self, stage):
+		max_bytes_billed = self.get_max_bytes_billed(stage.name)
+		if not max_bytes_billed:
+			return None
+		return bigquery.QueryJobConfig(maximum_bytes_billed=max_bytes_billed)
+	
+	def submit_labels(self, poll_interval=1.0):
+		'''
+		Starts the pipeline without blocking and returns a PipelineRun handle.
+		Stage jobs are submitted and polled from a single driver thread, with up to max_workers jobs running at once.
+		Byte budgets are checked before anything starts, as in create_labels. Incremental and single-script runs are 
+		submitted as one labelled_cohort stage running create_labels_incremental or create_labels_script on a worker.
+		The handle's result is keyed by stage name; without save_to_database, 'labelled_cohort' holds the labels as a dataframe.
+		'''
+		if self.has_byte_budgets():
+			self.check_byte_budgets()
+		if self.config_dict['incremental']:
+			stages = [Stage('labelled_cohort', None, run=self.create_labels_incremental, component='SepsisLabeler')]
+		elif self.config_dict['single_script']:
+			stages = [Stage('labelled_cohort', None, run=self.create_labels_script, component='SepsisLabeler')]
+		else:
+			stages = self.get_stages()
+		scheduler = DAGScheduler(stages, max_workers=self.config_dict['max_workers'], verbose=self.verbose)
+		return scheduler.submit(self.submit_stage, complete=self.complete_stage, poll_interval=poll_interval)
+	
+	def submit_stage(self, stage):
+		'''
+		Starts the query job of a stage and returns it without waiting. Stages with a run function are run by the PipelineRun.
+		'''
+		query = stage.get_query()
+		if self.is_cached(stage, query):
+			return None
+		self.partitioning.check(query)
+		if self.verbose:
+			print(f'Submitting stage {stage.name}...')
+		return self.db.client.query(query, job_config=self.get_job_config(stage))
+	
+	def is_cached(self, stage, query):
+		if self.stage_cache is None:
+			return False
+		fingerprint = self.stage_cache.get_fingerprint(stage, query)
+		if self.stage_cache.is_valid(stage, fingerprint):
+			if self.verbose:
+				print(f'Skipping stage {stage.name}, output is up to date...')
+			return True
+		self.fingerprints[stage.name] = fingerprint
+		return False
+	
+	def complete_stage(self, stage, job=None):
+		if stage.name in self.fingerprints:
+			self.stage_cache.record(stage, self.fingerprints.pop(stage.name))
+		if job is not None and self.config_dict['collect_job_stats']:
+			self.job_stats.append(self.get_job_stats(stage, job))
+	
+	def get_job_stats(self, stage, job):
+		'''
+		Returns the statistics of the job that ran a stage. Scripts are reported with the totals of their child jobs.
+		'''
+		jobs = list(self.db.client.list_jobs(parent_job=job.job_id)) if job.num_child_jobs else [job]
+		plan = [entry for child in jobs for entry in (child.query_plan or [])]
+		rows_written = sum(child.num_dml_affected_rows or 0 for child in jobs)
+		if not rows_written:
+			# CREATE TABLE AS SELECT reports no affected rows, the final plan stage of each job writes the table
+			rows_written = sum(child.query_plan[-1].records_written or 0 for child in jobs if child.query_plan)
+		return {
+			'stage': stage.name,
+			'component': stage.component or stage.name,
+			'job_id': job.job_id,
+			'wall_seconds': (job.ended - job.started).total_seconds() if job.started and job.ended else None,
+			'slot_millis': job.slot_millis or 0,
+			'bytes_processed': job.total_bytes_processed or 0,
+			'bytes_billed': job.total_bytes_billed or 0,
+			'shuffle_bytes': sum(entry.shuffle_output_bytes or 0 for entry in plan),
+			'rows_written': rows_written,
+			'cache_hit': all(child.cache_hit for child in jobs),
+		}
+	
+	def get_job_report(self):
+		'''
+		Returns the statistics of every job run with collect_job_stats, most expensive first.
+		'''
+		return pd.DataFrame(self.job_stats, columns=self.job_stats_columns).sort_values(
+			['bytes_billed', 'slot_millis'], ascending=False
+		).reset_index(drop=True)
+	
+	def get_component_report(self):
+		'''
+		Returns the job statistics summed per component, most expensive first.
+		'''
+		report = self.get_job_report()
+		return report.groupby('component', as_index=False)[
+			['wall_seconds', 'slot_millis', 'bytes_processed', 'bytes_billed', 'shuffle_bytes', 'rows_written']
+		].sum().sort_values(['bytes_billed', 'slot_millis'], ascending=False).reset_index(drop=True)
+	
+	def analyze_query_plans(self):
+		'''
+		Returns the join fan-out, compute skew and repeated reads found in the plans of the jobs run with collect_job_stats.
+		'''
+		analyzer = QueryPlanAnalyzer(
+			self.db.client, 
+			fanout_threshold=self.config_dict['plan_fanout_threshold'], 
+			skew_threshold=self.config_dict['plan_skew_threshold']
+		)
+		return analyzer.analyze(self.job_stats)
+	
+	def get_job_report_json(self):
+		return json.dumps({
+			'stages': json.loads(self.get_job_report().to_json(orient='records')),
+			'components': json.loads(self.get_component_report().to_json(orient='records')),
+		}, indent=2)
+	
 	def extract_flowsheets(self):
 		if self.config_dict['extract_flowsheet']:
 			if self.verbose:
 				print('Extracting flowsheets from observation table...')
-			STARRFlowsheetExtract(**self.config_dict).create_cohort_table()
+			self.get_flowsheet_extract().create_cohort_table()
+	
+	def get_flowsheet_extract(self):
+		'''
+		Returns the flowsheet extract, with the registry of the flowsheet rows declared by the components that read them.
+		'''
+		components = [component for _, component in self.get_event_extracts() + self.get_component_jobs()]
+		component_classes = [getattr(component, 'component_class', type(component)) for component in components]
+		display_names = []
+		for component_class in component_classes:
+			display_names.extend(name for name in component_class.flowsheet_display_names if name not in display_names)
+		return STARRFlowsheetExtract(db=self.db, **{
+			**self.config_dict,
+			'flowsheet_display_names': display_names,
+			'flowsheet_admission_days': any(component_class.flowsheet_admission_days for component_class in component_classes),
+		})
 	
 	def create_cohort(self):
 		if self.config_dict['pre_existing_cohort']:
@@ -51,22 +800,55 @@ class SepsisLabeler:
 		else:
 			if self.verbose:
 				print(f'Creating admission cohort: {self.config_dict["admission_rollup"]}')
-			SepsisAdmissionCohort(**self.config_dict).create_cohort_table()
+			self.cohort.create_cohort_table()
 			if self.verbose:
 				print(f'Admission cohort created...')
 	
+	def create_event_extracts(self):
+		for name, extract in self.get_event_extracts():
+			if self.verbose:
+				print(f'Creating {name} table...')
+			extract.create_component_table()
+	
+	def get_event_extracts(self):
+		'''
+		Returns (name, extract) pairs for the enabled shared extracts that components read instead of the source tables.
+		'''
+		extracts = []
+		if self.config_dict['use_measurement_extract']:
+			extracts.append(('measurement_extract', MeasurementExtract(db=self.db, **self.config_dict)))
+		if self.config_dict['use_daily_aggregates']:
+			extracts.append(('daily_measurement_store', DailyMeasurementStore(db=self.db, **self.config_dict)))
+		if self.config_dict['use_respiratory_extract']:
+			extracts.append(('respiratory_extract', RespiratoryFlowsheetExtract(db=self.db, **self.config_dict)))
+		if self.config_dict['use_drug_extract']:
+			extracts.append(('drug_extract', DrugExposureExtract(db=self.db, **self.config_dict)))
+		if self.config_dict['use_observation_bounds']:
+			extracts.append(('observation_bounds', ObservationBoundsExtract(db=self.db, **self.config_dict)))
+		return extracts
+	
 	def create_sofa(self):
 		if self.verbose:
 				print(f'Creating SOFA scores...')
-		SOFAScore(**self.config_dict).create_sofa_tables()
+		SOFAScore(db=self.db, **self.config_dict).create_sofa_tables()
 	
 	def create_labelled_cohort(self):
 		if self.verbose:
 			print('Adding SEPSIS label to cohort...')
+		if not self.config_dict["save_to_database"]:
+			return self.read_labelled_cohort()
+		else:
+			self.db.execute_sql(self.get_labelled_cohort_query())
+			return None
+	
+	def get_labelled_cohort_table(self):
 		if self.config_dict["replace_cohort"]:
-			cohort_name = self.config_dict['admission_rollup']
+			return self.config_dict['labelled_cohort']
 		else:
-			cohort_name = f"{self.config_dict['admission_rollup']}_labeled"
+			return f"{self.config_dict['admission_rollup']}_labeled"
+	
+	def get_labelled_cohort_query(self, cohort_name=None):
+		cohort_name = cohort_name or self.get_labelled_cohort_table()
 		query = '''
 				{save_query}
 				SELECT adm.*,
@@ -79,19 +861,42 @@ class SepsisLabeler:
 				{admission_rollup} adm
 				LEFT JOIN {sepsis_difference} sep on sep.person_id = adm.person_id and sep.admit_date = CAST(adm.admit_date as DATE)
 				'''
-		query = query.format_map({**self.config_dict,
-								  **{"save_query": f"CREATE OR REPLACE TABLE `{cohort_name}` AS" if self.config_dict["save_to_database"] else ""}
-								 })
-		if not self.config_dict["save_to_database"]:
-			return pd.read_gbq(query, dialect='standard')
-		else:
-			self.db.execute_sql(query)
-			return None
+		return query.format_map({**self.config_dict,
+								 **{"save_query": f"CREATE OR REPLACE TABLE `{cohort_name}` {self.get_table_options_str()} AS" if self.config_dict["save_to_database"] else ""}
+								})
+	
+	def get_table_options_str(self):
+		'''
+		Returns the PARTITION BY and CLUSTER BY options of the labelled cohort, if partition_tables is set.
+		admit_date is truncated with the function of its type, since a pre-existing cohort may store it as a DATE.
+		'''
+		if not self.config_dict['partition_tables']:
+			return ''
+		return f"PARTITION BY {self.get_admit_date_type()}_TRUNC(admit_date, {self.config_dict['partition_granularity']}) CLUSTER BY person_id"
+	
+	def get_admit_date_type(self):
+		'''
+		Returns the type of admit_date in the cohort. The cohort this labeler builds has DATETIME admit dates, a pre-existing one is looked up.
+		'''
+		if self.config_dict['admit_date_type'] is not None:
+			return self.config_dict['admit_date_type']
+		if not self.config_dict['pre_existing_cohort']:
+			return 'DATETIME'
+		schema = self.db.client.get_table(self.config_dict['admission_rollup']).schema
+		return next(field.field_type for field in schema if field.name == 'admit_date')
+	
+	def read_labelled_cohort(self):
+		max_bytes_billed = self.get_max_bytes_billed('labelled_cohort')
+		configuration = {'query': {'maximumBytesBilled': str(max_bytes_billed)}} if max_bytes_billed else None
+		return pd.read_gbq(self.get_labelled_cohort_query(), dialect='standard', configuration=configuration)
 	
 	def create_components(self):
 		if self.verbose:
 			print('Creating suspected infection list...')
 		self.get_suspected_infection()
+		if self.config_dict['parallel_components'] or self.config_dict['fused_components']:
+			self.run_components()
+			return
 		if self.verbose:
 			print('Creating platelet component table...')
 		self.get_platelet()
@@ -122,6 +927,11 @@ class SepsisLabeler:
 		if self.verbose:
 			print('Creating urine component table...')
 		self.get_urine()
+		if self.config_dict['combined_vasopressors']:
+			if self.verbose:
+				print('Creating vasopressor component table...')
+			self.get_vasopressors()
+			return
 		if self.verbose:
 			print('Creating dopamine component table...')
 		self.get_dopamine()
@@ -135,64 +945,114 @@ class SepsisLabeler:
 			print('Creating norepinephrine component table...')
 		self.get_norepinephrine()
 	
+	def get_component_jobs(self):
+		'''
+		Returns (name, component) pairs for every component job that only depends on the suspected infection table.
+		With fused_components, each job builds both the current and the prior window table.
+		'''
+		component_classes = [
+			('platelet', PlateletComponent),
+			('creatinine', CreatinineComponent),
+			('gcs', GlasgowComaScaleComponent),
+			('bilirubin', BilirubinComponent),
+			('mech_vent', MechanicalVentilationComponent),
+			('lactate', LactateComponent),
+			('pao2_fio2', PaO2FiO2Component),
+			('spo2_fio2', SpO2FiO2Component),
+			('map', MeanArterialPressureComponent),
+			('urine', UrineComponent),
+		]
+		if not self.config_dict['combined_vasopressors']:
+			component_classes += [
+				('dopamine', DopamineComponent),
+				('dobutamine', DobutamineComponent),
+				('epinephrine', EpinephrineComponent),
+				('norepinephrine', NorepinephrineComponent),
+			]
+		jobs = []
+		if self.config_dict['combined_vasopressors']:
+			# A single job scans drug_exposure once for both windows and all four vasopressors
+			jobs.append(('vasopressor', FusedComponent(VasopressorComponent, db=self.db, **self.config_dict)))
+		for name, component_class in component_classes:
+			if self.config_dict['fused_components']:
+				jobs.append((name, FusedComponent(component_class, db=self.db, **self.config_dict)))
+				continue
+			jobs.append((name, component_class(db=self.db, **self.config_dict)))
+			jobs.append((f'{name}_prior', component_class(prior=True, db=self.db, **self.config_dict)))
+		return jobs
+	
+	def run_components(self):
+		'''
+		Creates the component tables, concurrently on a thread pool of max_workers threads if parallel_components is set.
+		Every started job is allowed to finish; failures are collected per job and raised together at the end.
+		'''
+		stages = [self.get_component_stage(name, component) for name, component in self.get_component_jobs()]
+		max_workers = self.config_dict['max_workers'] if self.config_dict['parallel_components'] else 1
+		if self.verbose:
+			print(f'Creating component tables with {len(stages)} jobs on {max_workers} workers...')
+		DAGScheduler(stages, max_workers=max_workers, verbose=self.verbose).run(self.run_stage)
+	
 	def get_suspected_infection(self):
-		SuspectedInfectionComponent(**self.config_dict).create_component_table()
+		SuspectedInfectionComponent(db=self.db, **self.config_dict).create_component_table()
 	
 	def get_platelet(self):
-		PlateletComponent(**self.config_dict).create_component_table()
-		PlateletComponent(prior=True, **self.config_dict).create_component_table()
+		PlateletComponent(db=self.db, **self.config_dict).create_component_table()
+		PlateletComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 		
 	def get_creatinine(self):
-		CreatinineComponent(**self.config_dict).create_component_table()
-		CreatinineComponent(prior=True, **self.config_dict).create_component_table()
+		CreatinineComponent(db=self.db, **self.config_dict).create_component_table()
+		CreatinineComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 	
 	def get_gcs(self):
-		GlasgowComaScaleComponent(**self.config_dict).create_component_table()
-		GlasgowComaScaleComponent(prior=True, **self.config_dict).create_component_table()
+		GlasgowComaScaleComponent(db=self.db, **self.config_dict).create_component_table()
+		GlasgowComaScaleComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 	
 	def get_bilirubin(self):
-		BilirubinComponent(**self.config_dict).create_component_table()
-		BilirubinComponent(prior=True, **self.config_dict).create_component_table()
+		BilirubinComponent(db=self.db, **self.config_dict).create_component_table()
+		BilirubinComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 	
 	def get_mech_vent(self):
-		MechanicalVentilationComponent(**self.config_dict).create_component_table()
-		MechanicalVentilationComponent(prior=True, **self.config_dict).create_component_table()
+		MechanicalVentilationComponent(db=self.db, **self.config_dict).create_component_table()
+		MechanicalVentilationComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 	
 	def get_lactate(self):
-		LactateComponent(**self.config_dict).create_component_table()
-		LactateComponent(prior=True, **self.config_dict).create_component_table()
+		LactateComponent(db=self.db, **self.config_dict).create_component_table()
+		LactateComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 	
 	def get_pao2_fio2(self):
-		PaO2FiO2Component(**self.config_dict).create_component_table()
-		PaO2FiO2Component(prior=True, **self.config_dict).create_component_table()
+		PaO2FiO2Component(db=self.db, **self.config_dict).create_component_table()
+		PaO2FiO2Component(prior=True, db=self.db, **self.config_dict).create_component_table()
 	
 	def get_spo2_fio2(self):
-		SpO2FiO2Component(**self.config_dict).create_component_table()
-		SpO2FiO2Component(prior=True, **self.config_dict).create_component_table()
+		SpO2FiO2Component(db=self.db, **self.config_dict).create_component_table()
+		SpO2FiO2Component(prior=True, db=self.db, **self.config_dict).create_component_table()
 	
 	def get_map(self):
-		MeanArterialPressureComponent(**self.config_dict).create_component_table()
-		MeanArterialPressureComponent(prior=True, **self.config_dict).create_component_table()
+		MeanArterialPressureComponent(db=self.db, **self.config_dict).create_component_table()
+		MeanArterialPressureComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 	
 	def get_urine(self):
-		UrineComponent(**self.config_dict).create_component_table()
-		UrineComponent(prior=True, **self.config_dict).create_component_table()
+		UrineComponent(db=self.db, **self.config_dict).create_component_table()
+		UrineComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 	
 	def get_dopamine(self):
-		DopamineComponent(**self.config_dict).create_component_table()
-		DopamineComponent(prior=True, **self.config_dict).create_component_table()
+		DopamineComponent(db=self.db, **self.config_dict).create_component_table()
+		DopamineComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 
 	def get_dobutamine(self):
-		DobutamineComponent(**self.config_dict).create_component_table()
-		DobutamineComponent(prior=True, **self.config_dict).create_component_table()
+		DobutamineComponent(db=self.db, **self.config_dict).create_component_table()
+		DobutamineComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 
 	def get_epinephrine(self):
-		EpinephrineComponent(**self.config_dict).create_component_table()
-		EpinephrineComponent(prior=True, **self.config_dict).create_component_table()
+		EpinephrineComponent(db=self.db, **self.config_dict).create_component_table()
+		EpinephrineComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
 
 	def get_norepinephrine(self):
-		NorepinephrineComponent(**self.config_dict).create_component_table()
-		NorepinephrineComponent(prior=True, **self.config_dict).create_component_table()
+		NorepinephrineComponent(db=self.db, **self.config_dict).create_component_table()
+		NorepinephrineComponent(prior=True, db=self.db, **self.config_dict).create_component_table()
+		
+	def get_vasopressors(self):
+		FusedComponent(VasopressorComponent, db=self.db, **self.config_dict).create_component_table()
 		
 	def get_defaults(self):
 		
@@ -211,10 +1071,46 @@ class SepsisLabeler:
 			"min_stay_hour":0,
 			"verbose":True,
 			"print_query":False,
+			"partition_tables":False,
+			"partition_granularity":"MONTH",
+			"admit_date_type":None,
 			"pre_existing_cohort":None,
 			"extract_flowsheet":False,
 			"save_to_database":True,
 			"replace_cohort":True,
+			"parallel_components":False,
+			"max_workers":8,
+			"dag_scheduler":False,
+			"fused_components":False,
+			"use_measurement_extract":False,
+			"use_respiratory_extract":False,
+			"use_drug_extract":False,
+			"use_daily_aggregates":False,
+			"use_observation_bounds":False,
+			"asof_fio2_join":False,
+			"bounded_infection_join":False,
+			"fast_admission_rollup":False,
+			"targeted_flowsheet_extract":False,
+			"incremental_flowsheet":False,
+			"flowsheet_slice_months":12,
+			"flowsheet_visit_concept_ids":[9201, 262],
+			"flowsheet_visit_max_days":30,
+			"daily_store_refresh_days":3,
+			"cohort_scoped_extracts":False,
+			"extract_lookback_days":11,
+			"extract_lookahead_days":3,
+			"combined_vasopressors":False,
+			"stage_cache":False,
+			"incremental":False,
+			"single_script":False,
+			"persist_tables":[],
+			"max_bytes_billed":None,
+			"stage_max_bytes_billed":{},
+			"strict_byte_budgets":False,
+			"collect_job_stats":False,
+			"plan_fanout_threshold":10,
+			"plan_skew_threshold":5,
+			"incremental_lookback_days":7,
 			"meas_window_prior":'''DATE_SUB(CAST(sepsis_index_date AS DATE), INTERVAL 2 DAY) > CAST(measurement_DATETIME AS DATE) AND
 								   DATE_SUB(CAST(sepsis_index_date AS DATE), INTERVAL 10 DAY) <= CAST(measurement_DATETIME AS DATE)''',
 			"meas_window":'''CAST(sepsis_index_date AS DATE) >= CAST(DATETIME_SUB(measurement_DATETIME, INTERVAL 2 DAY) AS DATE) AND
@@ -246,8 +1142,17 @@ class SepsisLabeler:
 		config_dict = self.override_defaults(**kwargs)
 		
 		table_names = {
-			"admission_rollup": config_dict['cohort_name'] if config_dict['pre_existing_cohort'] else "sepsis_admission_rollup",
+			"admission_rollup": config_dict['cohort_name'] if config_dict['pre_existing_cohort'] else (
+				# The labels replace the cohort table, so a cached run builds its cohort into a working table that the labelling does not modify
+				"sepsis_admission_rollup_unlabeled" if config_dict['stage_cache'] and config_dict['replace_cohort'] else "sepsis_admission_rollup"
+			),
+			"labelled_cohort": config_dict['cohort_name'] if config_dict['pre_existing_cohort'] else "sepsis_admission_rollup",
 			"suspected_infection": "sepsis_susp_inf_rollup",
+			"sepsis_measurement": "sepsis_measurement_extract",
+			"sepsis_resp_flowsheet": "sepsis_resp_flowsheet_extract",
+			"sepsis_drug": "sepsis_drug_extract",
+			"sepsis_daily_measurement": "sepsis_daily_measurement",
+			"sepsis_obs_bounds": "sepsis_observation_bounds",
 			"sepsis_platelet": "sepsis_platelet_rollup",
 			"sepsis_creatinine": "sepsis_creatinine_rollup",
 			"sepsis_bilirubin": "sepsis_bilirubin_rollup",
@@ -262,8 +1167,13 @@ class SepsisLabeler:
 			"sepsis_dobutamine": "sepsis_dobutamine_rollup",
 			"sepsis_epinephrine": "sepsis_epinephrine_rollup",
 			"sepsis_norepinephrine": "sepsis_norepinephrine_rollup",
+			"sepsis_vasopressor": "sepsis_vasopressor_rollup",
 			"sepsis_sofa":"sepsis_sofa_score",
-			"sepsis_difference": "sepsis_sofa_difference"
+			"sepsis_difference": "sepsis_sofa_difference",
+			"sepsis_stage_cache": "sepsis_stage_cache",
+			"sepsis_watermark": "sepsis_label_watermark",
+			"admission_delta": "sepsis_admission_delta",
+			"admission_events": "sepsis_admission_events"
 		}
 		table_names_long = {
 			key: "{rs_dataset_project}.{rs_dataset}.{table_name}".format(
@@ -272,7 +1182,8 @@ class SepsisLabeler:
 			for key, value in table_names.items()
 		}
 		
-		config_dict = {**config_dict, **table_names_long}
+		# Table names passed explicitly, e.g. by a labeler handing its config to another, are kept
+		config_dict = {**config_dict, **{key: value for key, value in table_names_long.items() if key not in kwargs}}
 
 		# Handle special parameters
 		config_dict["limit_str"] = (
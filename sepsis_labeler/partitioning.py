@@ -0,0 +1,64 @@
+import re
+import warnings
+from google.api_core.exceptions import NotFound
+
+class PartitioningCheck:
+	'''
+	Finds the tables a query replaces with CREATE OR REPLACE TABLE under a different partitioning spec than they have,
+	e.g. after partition_tables, partition_granularity or incremental_flowsheet changed, since BigQuery refuses to replace them.
+	A table the query does not read is dropped, as the query rebuilds it. A table it also reads, like a pre-existing cohort
+	labelled in place, is first rebuilt under the new spec from its own rows, so the query still finds them.
+	'''
+	create_pattern = re.compile(r'CREATE OR REPLACE TABLE\s+`?([\w.-]+)`?\s+(.*?)\bAS\b', re.I | re.S)
+	partition_pattern = re.compile(r'PARTITION BY\s+(?:\w+_TRUNC\(\s*(\w+)\s*,\s*(\w+)\s*\)|(\w+)\b(?!\s*\())', re.I)
+
+	def __init__(self, db):
+		self.db = db
+
+	def check(self, query):
+		for table, options in self.create_pattern.findall(query):
+			try:
+				info = self.db.client.get_table(table)
+			except NotFound:
+				continue
+			partitioning = self.get_partitioning(options)
+			if self.get_table_partitioning(info) == partitioning:
+				continue
+			if self.is_read(table, query):
+				warnings.warn(f'{table} is partitioned differently than the query replacing it, rebuilding it under the new spec')
+				self.db.execute_sql(self.get_repartition_query(table, info.table_id, options))
+			else:
+				warnings.warn(f'{table} is partitioned differently than the query replacing it, dropping it')
+				self.db.execute_sql(f'DROP TABLE `{table}`')
+
+	def get_partitioning(self, options):
+		'''
+		Returns the (column, granularity) a PARTITION BY clause partitions on, or None without one.
+		'''
+		match = self.partition_pattern.search(options)
+		if match is None:
+			return None
+		if match.group(3) is not None:
+			return match.group(3), 'DAY'
+		return match.group(1), match.group(2).upper()
+
+	def get_table_partitioning(self, info):
+		if info.range_partitioning is not None:
+			return info.range_partitioning.field, 'RANGE'
+		if info.time_partitioning is None:
+			return None
+		return info.time_partitioning.field, info.time_partitioning.type_
+
+	def is_read(self, table, query):
+		return len(re.findall(rf'(?<![\w.-]){re.escape(table)}(?![\w-])', query)) > 1
+
+	def get_repartition_query(self, table, table_id, options):
+		'''
+		The rows are kept in a _repartitioned table until it is renamed, so a failure in between does not lose them.
+		'''
+		return f'''
+				CREATE OR REPLACE TABLE `{table}_repartitioned` {options.strip()} AS
+				SELECT * FROM `{table}`;
+				DROP TABLE `{table}`;
+				ALTER TABLE `{table}_repartitioned` RENAME TO `{table_id}`;
+				'''
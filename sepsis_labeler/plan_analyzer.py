@@ -0,0 +1,87 @@
+import re
+import pandas as pd
+
+class QueryPlanAnalyzer:
+	'''
+	Inspects the execution plans of finished stage jobs and flags the plan stages worth optimizing:
+	joins whose output has many more rows than their input, plan stages whose slowest worker is far slower than the average,
+	and source tables read by more than one plan stage of a job, which is how CTEs referenced twice show up.
+	'''
+	columns = ['stage', 'component', 'job_id', 'plan_stage', 'issue', 'value', 'detail']
+
+	def __init__(self, client, fanout_threshold=10, skew_threshold=5, min_skew_ms=1000):
+		self.client = client
+		self.fanout_threshold = fanout_threshold
+		self.skew_threshold = skew_threshold
+		self.min_skew_ms = min_skew_ms
+
+	def analyze(self, job_stats):
+		'''
+		Returns a dataframe of the issues found in the jobs of job_stats, a list of dicts with stage, component and job_id.
+		'''
+		issues = []
+		for row in job_stats:
+			job = self.client.get_job(row['job_id'])
+			jobs = list(self.client.list_jobs(parent_job=job.job_id)) if job.num_child_jobs else [job]
+			for child in jobs:
+				for issue in self.get_issues(child):
+					issues.append({'stage': row['stage'], 'component': row['component'], 'job_id': child.job_id, **issue})
+		return pd.DataFrame(issues, columns=self.columns)
+
+	def get_issues(self, job):
+		plan = job.query_plan or []
+		return self.get_join_fanout(plan) + self.get_compute_skew(plan) + self.get_repeated_reads(plan)
+
+	def get_join_fanout(self, plan):
+		issues = []
+		for entry in plan:
+			joins = [step for step in entry.steps if step.kind == 'JOIN']
+			if not joins or not entry.records_read:
+				continue
+			ratio = (entry.records_written or 0) / entry.records_read
+			if ratio >= self.fanout_threshold:
+				issues.append({
+					'plan_stage': entry.name,
+					'issue': 'join_fanout',
+					'value': ratio,
+					'detail': '; '.join(substep for step in joins for substep in step.substeps),
+				})
+		return issues
+
+	def get_compute_skew(self, plan):
+		issues = []
+		for entry in plan:
+			if not entry.compute_ms_avg or (entry.compute_ms_max or 0) < self.min_skew_ms:
+				continue
+			ratio = entry.compute_ms_max / entry.compute_ms_avg
+			if ratio >= self.skew_threshold:
+				issues.append({
+					'plan_stage': entry.name,
+					'issue': 'compute_skew',
+					'value': ratio,
+					'detail': f'max {entry.compute_ms_max} ms, avg {entry.compute_ms_avg} ms',
+				})
+		return issues
+
+	def get_repeated_reads(self, plan):
+		'''
+		Plan stages read the outputs of other plan stages as __stageNN_output; every other FROM is a table scan.
+		'''
+		reads = {}
+		for entry in plan:
+			for step in entry.steps:
+				if step.kind != 'READ':
+					continue
+				for substep in step.substeps:
+					match = re.match(r'FROM\s+`?([\w.\-]+)`?', substep)
+					if match and not match.group(1).startswith('__stage'):
+						reads.setdefault(match.group(1), []).append(entry.name)
+		return [
+			{
+				'plan_stage': ', '.join(names),
+				'issue': 'repeated_read',
+				'value': len(names),
+				'detail': table,
+			}
+			for table, names in reads.items() if len(names) > 1
+		]
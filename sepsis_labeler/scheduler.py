@@ -0,0 +1,265 @@
+import heapq
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class Stage:
+	'''
+	A single job in the labeling pipeline.
+	Each stage declares the tables it reads and writes. Tables that no stage writes are treated as pre-existing.
+	component names the class whose query the stage runs, for reporting.
+	A stage with a run function can give an estimate function returning the queries it runs, so they can be dry-run.
+	'''
+	def __init__(self, name, query, reads=(), writes=(), run=None, weight=1, component=None, estimate=None):
+		self.name = name
+		self.query = query
+		self.reads = list(reads)
+		self.writes = list(writes)
+		self.run = run
+		self.weight = weight
+		self.component = component
+		self.estimate = estimate
+	
+	def get_query(self):
+		return self.query() if callable(self.query) else self.query
+
+class DAGScheduler:
+	'''
+	Runs pipeline stages as soon as the tables they read exist.
+	Ready stages are started in order of their longest remaining path, so the critical path is never left waiting.
+	'''
+	def __init__(self, stages, max_workers=1, verbose=False):
+		self.stages = {}
+		for stage in stages:
+			if stage.name in self.stages:
+				raise ValueError(f'Duplicate stage name: {stage.name}')
+			self.stages[stage.name] = stage
+		self.max_workers = max_workers
+		self.verbose = verbose
+		self.dependencies = self.get_dependencies()
+		self.dependents = {name: set() for name in self.stages}
+		for name, dependencies in self.dependencies.items():
+			for dependency in dependencies:
+				self.dependents[dependency].add(name)
+		self.order = self.get_order()
+		self.priorities = self.get_priorities()
+	
+	def get_dependencies(self):
+		writers = {}
+		for stage in self.stages.values():
+			for table in stage.writes:
+				if table in writers:
+					raise ValueError(f'Table {table} is written by both {writers[table]} and {stage.name}')
+				writers[table] = stage.name
+		return {
+			name: {writers[table] for table in stage.reads if table in writers and writers[table] != name}
+			for name, stage in self.stages.items()
+		}
+	
+	def get_order(self):
+		'''
+		Returns the stage names in a topological order. Raises if the declared tables form a cycle.
+		'''
+		remaining = {name: set(dependencies) for name, dependencies in self.dependencies.items()}
+		ready = sorted(name for name, dependencies in remaining.items() if not dependencies)
+		order = []
+		while ready:
+			name = ready.pop(0)
+			order.append(name)
+			for dependent in sorted(self.dependents[name]):
+				remaining[dependent].discard(name)
+				if not remaining[dependent]:
+					ready.append(dependent)
+		if len(order) != len(self.stages):
+			cycle = sorted(set(self.stages) - set(order))
+			raise ValueError(f'Stages form a dependency cycle: {", ".join(cycle)}')
+		return order
+	
+	def get_priorities(self):
+		'''
+		Returns the weight of the longest path from each stage to the end of the pipeline.
+		'''
+		priorities = {}
+		for name in reversed(self.order):
+			priorities[name] = self.stages[name].weight + max(
+				(priorities[dependent] for dependent in self.dependents[name]), default=0
+			)
+		return priorities
+	
+	def run(self, execute):
+		'''
+		Calls execute(stage) for every stage and returns the results keyed by stage name.
+		After a failure no new stages are started; running stages finish and all errors are raised together.
+		'''
+		remaining = {name: set(dependencies) for name, dependencies in self.dependencies.items()}
+		ready = [(-self.priorities[name], name) for name, dependencies in remaining.items() if not dependencies]
+		heapq.heapify(ready)
+		results, errors, running = {}, {}, {}
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			while ready or running:
+				while ready and len(running) < self.max_workers and not errors:
+					_, name = heapq.heappop(ready)
+					running[executor.submit(execute, self.stages[name])] = name
+				if not running:
+					break
+				done, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in done:
+					name = running.pop(future)
+					try:
+						results[name] = future.result()
+					except Exception as e:
+						errors[name] = e
+						if self.verbose:
+							print(f'Stage {name} failed: {e}')
+						continue
+					for dependent in self.dependents[name]:
+						remaining[dependent].discard(name)
+						if not remaining[dependent]:
+							heapq.heappush(ready, (-self.priorities[dependent], dependent))
+		if errors:
+			raise self.get_error(errors)
+		return results
+	
+	def get_error(self, errors):
+		return RuntimeError(
+			'Failed stages:\n' + '\n'.join(f'{name}: {e}' for name, e in errors.items())
+		)
+	
+	def submit(self, submit, complete=None, poll_interval=1.0):
+		'''
+		Starts the stages on a single driver thread and returns a PipelineRun handle without waiting for them.
+		submit(stage) starts the job of a stage and returns it, or returns the result of a stage that already finished.
+		Stages with a run function are not passed to submit; they run on a worker thread and are polled like jobs.
+		complete(stage, job) is called once the job of a stage succeeded.
+		Jobs are polled with job.done() every poll_interval seconds, so no thread blocks on a running job.
+		'''
+		return PipelineRun(self, submit, complete, poll_interval)
+
+class PipelineRun:
+	'''
+	Handle on a pipeline started with DAGScheduler.submit.
+	It can be polled with status() and done(), waited on with result(), awaited from asyncio, and cancelled.
+	'''
+	def __init__(self, scheduler, submit, complete=None, poll_interval=1.0):
+		self.scheduler = scheduler
+		self.submit = submit
+		self.complete = complete
+		self.poll_interval = poll_interval
+		self.future = Future()
+		self.cancelled = threading.Event()
+		self.statuses = {name: 'pending' for name in scheduler.order}
+		self.running = {}
+		self.workers = ThreadPoolExecutor(max_workers=scheduler.max_workers)
+		self.thread = threading.Thread(target=self.drive, daemon=True)
+		self.thread.start()
+	
+	def __await__(self):
+		return asyncio.wrap_future(self.future).__await__()
+	
+	def status(self):
+		'''
+		Returns the status of every stage: pending, running, done, failed or cancelled.
+		'''
+		return dict(self.statuses)
+	
+	def done(self):
+		return self.future.done()
+	
+	def result(self, timeout=None):
+		return self.future.result(timeout)
+	
+	def cancel(self):
+		'''
+		Stops starting stages and cancels the running jobs.
+		'''
+		self.cancelled.set()
+		return self.future.cancel()
+	
+	def drive(self):
+		'''
+		Runs the pipeline on the driver thread. An error outside of the stages fails the handle instead of leaving it pending.
+		'''
+		try:
+			self.schedule()
+		except Exception as e:
+			for job in self.running.values():
+				job.cancel()
+			for name, status in self.statuses.items():
+				if status in ('pending', 'running'):
+					self.statuses[name] = 'cancelled'
+			if self.future.set_running_or_notify_cancel():
+				self.future.set_exception(e)
+		finally:
+			# Stages already running on a worker finish on their own, but nothing waits for them
+			self.workers.shutdown(wait=False)
+	
+	def schedule(self):
+		scheduler = self.scheduler
+		remaining = {name: set(dependencies) for name, dependencies in scheduler.dependencies.items()}
+		ready = [(-scheduler.priorities[name], name) for name, dependencies in remaining.items() if not dependencies]
+		heapq.heapify(ready)
+		results, errors, running = {}, {}, self.running
+		
+		def finish(name, result):
+			results[name] = result
+			self.statuses[name] = 'done'
+			for dependent in scheduler.dependents[name]:
+				remaining[dependent].discard(name)
+				if not remaining[dependent]:
+					heapq.heappush(ready, (-scheduler.priorities[dependent], dependent))
+		
+		def fail(name, e):
+			errors[name] = e
+			self.statuses[name] = 'failed'
+			if scheduler.verbose:
+				print(f'Stage {name} failed: {e}')
+		
+		while (ready or running) and not self.cancelled.is_set():
+			while ready and len(running) < scheduler.max_workers and not errors:
+				_, name = heapq.heappop(ready)
+				stage = scheduler.stages[name]
+				self.statuses[name] = 'running'
+				if stage.run is not None:
+					running[name] = self.workers.submit(stage.run)
+					continue
+				try:
+					job = self.submit(stage)
+				except Exception as e:
+					fail(name, e)
+					continue
+				if hasattr(job, 'done'):
+					running[name] = job
+				else:
+					finish(name, job)
+			if not running:
+				break
+			finished = False
+			for name, job in list(running.items()):
+				try:
+					if not job.done():
+						continue
+					result = job.result()
+					if self.complete is not None and scheduler.stages[name].run is None:
+						self.complete(scheduler.stages[name], job)
+				except Exception as e:
+					running.pop(name)
+					fail(name, e)
+					finished = True
+					continue
+				running.pop(name)
+				finish(name, result)
+				finished = True
+			if not finished:
+				self.cancelled.wait(self.poll_interval)
+		
+		# The future stays pending until here, so cancel() can still resolve it as cancelled
+		if self.cancelled.is_set() or not self.future.set_running_or_notify_cancel():
+			for name, job in running.items():
+				job.cancel()
+			for name, status in self.statuses.items():
+				if status in ('pending', 'running'):
+					self.statuses[name] = 'cancelled'
+		elif errors:
+			self.future.set_exception(scheduler.get_error(errors))
+		else:
+			self.future.set_result(results)
@@ -2,13 +2,36 @@ import os
 from prediction_utils.extraction_utils.database import BQDatabase
 
 class SOFAScore:
-	def __init__(self, prior=False, *args, **kwargs):
+	component_keys = [
+		'sepsis_platelet',
+		'sepsis_bilirubin',
+		'sepsis_creatinine',
+		'sepsis_dopamine',
+		'sepsis_dobutamine',
+		'sepsis_epinephrine',
+		'sepsis_norepinephrine',
+		'sepsis_map',
+		'sepsis_pao2_fio2',
+		'sepsis_vent',
+		'sepsis_gcs',
+		'sepsis_urine',
+		'sepsis_lactate',
+		'sepsis_spo2_fio2',
+	]
+	vasopressor_keys = [
+		'sepsis_dopamine',
+		'sepsis_dobutamine',
+		'sepsis_epinephrine',
+		'sepsis_norepinephrine',
+	]
+	
+	def __init__(self, prior=False, *args, db=None, **kwargs):
 		self.config_dict = self.get_config_dict(**kwargs)
-		self.db = BQDatabase(**self.config_dict)
+		self.db = db if db is not None else BQDatabase(**self.config_dict)
 	
 	def get_difference_query(self, format_query=True):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_difference}` AS
+				CREATE OR REPLACE TABLE `{sepsis_difference}` {table_options_str} AS
 				SELECT 
 					cohort.person_id, 
 					cohort.admit_date, 
@@ -118,8 +141,7 @@ class SOFAScore:
 						{sepsis_sofa} as c USING (person_id, admit_date)
 					LEFT JOIN
 						{sepsis_sofa}_prior as p USING (person_id, admit_date)
-					ORDER BY
-						person_id, CAST(admit_date AS DATE)
+					{order_by_str}
 				'''
 		if not format_query:
 			pass
@@ -127,7 +149,9 @@ class SOFAScore:
 			query = query.format_map(
 							{**{"sepsis_difference": self.config_dict["sepsis_difference"],
 								"suspected_infection": self.config_dict["suspected_infection"],
-							    "sepsis_sofa": self.config_dict["sepsis_sofa"]}})
+							    "sepsis_sofa": self.config_dict["sepsis_sofa"],
+							    "table_options_str": self.config_dict["table_options_str"],
+							    "order_by_str": self.get_order_by_str()}})
 			
 		if self.config_dict['print_query']:
 			print(query)
@@ -136,7 +160,7 @@ class SOFAScore:
 
 	def get_score_query(self, format_query=True, prior=False):
 		query = '''
-				CREATE OR REPLACE TABLE `{sepsis_sofa}` AS
+				CREATE OR REPLACE TABLE `{sepsis_sofa}` {table_options_str} AS
 				SELECT 
                 susp_inf_rollup.person_id, 
                 CAST(susp_inf_rollup.admit_date AS DATE) AS admit_date, 
@@ -363,10 +387,7 @@ class SOFAScore:
             LEFT JOIN {sepsis_platelet} USING (person_id, admit_date)
             LEFT JOIN {sepsis_bilirubin} USING (person_id, admit_date)
             LEFT JOIN {sepsis_creatinine} USING (person_id, admit_date)
-            LEFT JOIN {sepsis_dopamine} USING (person_id, admit_date)
-			LEFT JOIN {sepsis_dobutamine} USING (person_id, admit_date)
-			LEFT JOIN {sepsis_epinephrine} USING (person_id, admit_date)
-			LEFT JOIN {sepsis_norepinephrine} USING (person_id, admit_date)
+            {vasopressor_joins}
             LEFT JOIN {sepsis_map} USING (person_id, admit_date)
             LEFT JOIN {sepsis_pao2_fio2} USING (person_id, admit_date)
             LEFT JOIN {sepsis_vent} USING (person_id, admit_date)
@@ -374,7 +395,7 @@ class SOFAScore:
             LEFT JOIN {sepsis_urine} USING (person_id, admit_date)
             LEFT JOIN {sepsis_lactate} USING (person_id, admit_date)
             LEFT JOIN {sepsis_spo2_fio2} USING (person_id, admit_date)
-            ORDER BY person_id, CAST(admit_date AS DATE)
+            {order_by_str}
 		'''
 		
 		if not format_query:
@@ -389,20 +410,53 @@ class SOFAScore:
 							"sepsis_vent":self.config_dict['sepsis_vent'] + '_prior' if prior else self.config_dict['sepsis_vent'],
 							"sepsis_lactate":self.config_dict['sepsis_lactate'] + '_prior' if prior else self.config_dict['sepsis_lactate'],
 							"sepsis_spo2_fio2":self.config_dict['sepsis_spo2_fio2'] + '_prior' if prior else self.config_dict['sepsis_spo2_fio2'],
-							"sepsis_dopamine":self.config_dict['sepsis_dopamine'] + '_prior' if prior else self.config_dict['sepsis_dopamine'],
-							"sepsis_dobutamine":self.config_dict['sepsis_dobutamine'] + '_prior' if prior else self.config_dict['sepsis_dobutamine'],
-							"sepsis_epinephrine":self.config_dict['sepsis_epinephrine'] + '_prior' if prior else self.config_dict['sepsis_epinephrine'],
-							"sepsis_norepinephrine":self.config_dict['sepsis_norepinephrine'] + '_prior' if prior else self.config_dict['sepsis_norepinephrine'],
+							"vasopressor_joins":self.get_vasopressor_joins(prior),
 							"sepsis_map":self.config_dict['sepsis_map'] + '_prior' if prior else self.config_dict['sepsis_map'],
 							"sepsis_urine":self.config_dict['sepsis_urine'] + '_prior' if prior else self.config_dict['sepsis_urine'],
 							"sepsis_pao2_fio2":self.config_dict['sepsis_pao2_fio2'] + '_prior' if prior else self.config_dict['sepsis_pao2_fio2'],
-						    "sepsis_sofa":self.config_dict["sepsis_sofa"] + '_prior' if prior else self.config_dict["sepsis_sofa"]}})
+						    "sepsis_sofa":self.config_dict["sepsis_sofa"] + '_prior' if prior else self.config_dict["sepsis_sofa"],
+						    "table_options_str":self.config_dict["table_options_str"],
+						    "order_by_str":self.get_order_by_str()}})
 			
 		if self.config_dict['print_query']:
 			print(query)
 			
 		return query
 	
+	def get_order_by_str(self):
+		# BigQuery rejects a top-level ORDER BY when the created table is partitioned or clustered
+		return "" if self.config_dict["partition_tables"] else "ORDER BY person_id, CAST(admit_date AS DATE)"
+	
+	def get_component_keys(self):
+		if self.config_dict['combined_vasopressors']:
+			return [key for key in self.component_keys if key not in self.vasopressor_keys] + ['sepsis_vasopressor']
+		return self.component_keys
+	
+	def get_vasopressor_joins(self, prior=False):
+		'''
+		Returns the joins adding the max_*_days vasopressor columns, from the combined vasopressor table if applicable.
+		'''
+		keys = ['sepsis_vasopressor'] if self.config_dict['combined_vasopressors'] else self.vasopressor_keys
+		return '\n\t\t\t'.join(
+			f"LEFT JOIN {self.config_dict[key] + '_prior' if prior else self.config_dict[key]} USING (person_id, admit_date)"
+			for key in keys
+		)
+	
+	def get_score_input_tables(self, prior=False):
+		return [self.config_dict['suspected_infection']] + [
+			self.config_dict[key] + '_prior' if prior else self.config_dict[key] for key in self.get_component_keys()
+		]
+	
+	def get_score_output_table(self, prior=False):
+		return self.config_dict['sepsis_sofa'] + '_prior' if prior else self.config_dict['sepsis_sofa']
+	
+	def get_difference_input_tables(self):
+		return [
+			self.config_dict['suspected_infection'],
+			self.get_score_output_table(),
+			self.get_score_output_table(prior=True),
+		]
+	
 	def run_score_queries(self):
 		self.db.execute_sql(self.get_score_query())
 		self.db.execute_sql(self.get_score_query(prior=True))
@@ -429,7 +483,10 @@ class SOFAScore:
 			"limit": None,
 			"min_stay_hour":0,
 			"print_query":False,
-			"save_sofa":True
+			"partition_tables":False,
+			"partition_granularity":"MONTH",
+			"save_sofa":True,
+			"combined_vasopressors":False
 		}
 
 	def override_defaults(self, **kwargs):
@@ -474,4 +531,9 @@ class SOFAScore:
 			)
 			else config_dict["gcloud_project"]
 		)
+		config_dict["table_options_str"] = (
+			"PARTITION BY DATE_TRUNC(admit_date, {}) CLUSTER BY person_id".format(config_dict["partition_granularity"])
+			if config_dict["partition_tables"]
+			else ""
+		)
 		return config_dict
\ No newline at end of file
@@ -0,0 +1,94 @@
+import calendar
+import threading
+from datetime import datetime, timedelta
+from google.cloud import bigquery
+
+class SourceChangeTracker:
+	'''
+	Finds the rows of source tables that may have changed since a point in time, from the last-modified times of the tables and their partitions.
+	The changed rows are selected with a filter on the partitioning column, so a scan restricted to them only reads the changed partitions.
+	Unpartitioned tables, and tables without a time, change as a whole. With since=None every row counts as changed.
+	'''
+	formats = {'HOUR': '%Y%m%d%H', 'DAY': '%Y%m%d', 'MONTH': '%Y%m', 'YEAR': '%Y'}
+
+	def __init__(self, db, since=None):
+		self.db = db
+		self.since = since
+		self.changes = {}
+		self.lock = threading.Lock()
+
+	def get_changes(self, table):
+		'''
+		Returns (partition_id, row_filter, partition_ids) for a table:
+		the SQL expression of the partition of a row, the SQL filter on the changed rows,
+		and the ids of the changed partitions, or None if the whole table changed.
+		Changes are looked up once per table, so every query of a run sees the same ones.
+		'''
+		with self.lock:
+			if table not in self.changes:
+				self.changes[table] = self.lookup_changes(self.db.client.get_table(table))
+			return self.changes[table]
+
+	def has_changed(self, table):
+		return self.get_changes(table)[1] != 'FALSE'
+
+	def lookup_changes(self, info):
+		column, column_type, granularity = self.get_partitioning(info)
+		partition_id = self.get_partition_id(column, column_type, granularity)
+		if self.since is not None and info.modified <= self.since:
+			return partition_id, 'FALSE', []
+		if self.since is None or column is None:
+			return partition_id, 'TRUE', None
+		partition_ids = self.get_changed_partitions(info)
+		# Rows still in the streaming buffer have no partition to select them by
+		if '__UNPARTITIONED__' in partition_ids:
+			return partition_id, 'TRUE', None
+		row_filter = ' OR '.join(
+			self.get_partition_filter(column, column_type, granularity, changed) for changed in partition_ids
+		)
+		return partition_id, row_filter or 'FALSE', partition_ids
+
+	def get_partitioning(self, info):
+		'''
+		Returns the partitioning column of a table, its type and the partition granularity, or Nones for a table without time partitions.
+		'''
+		partitioning = info.time_partitioning
+		if partitioning is None or partitioning.type_ not in self.formats:
+			return None, None, None
+		if partitioning.field is None:
+			return '_PARTITIONTIME', 'TIMESTAMP', partitioning.type_
+		column_type = next(field.field_type for field in info.schema if field.name == partitioning.field)
+		return partitioning.field, column_type, partitioning.type_
+
+	def get_partition_id(self, column, column_type, granularity):
+		if column is None:
+			return "'__TABLE__'"
+		return f"COALESCE(FORMAT_{column_type}('{self.formats[granularity]}', {column}), '__NULL__')"
+
+	def get_changed_partitions(self, info):
+		query = f'''
+				SELECT partition_id
+				FROM `{info.project}.{info.dataset_id}.INFORMATION_SCHEMA.PARTITIONS`
+				WHERE table_name = @table_name AND last_modified_time > @since
+				ORDER BY partition_id
+				'''
+		job_config = bigquery.QueryJobConfig(query_parameters=[
+			bigquery.ScalarQueryParameter('table_name', 'STRING', info.table_id),
+			bigquery.ScalarQueryParameter('since', 'TIMESTAMP', self.since),
+		])
+		return [row.partition_id for row in self.db.client.query(query, job_config=job_config).result()]
+
+	def get_partition_filter(self, column, column_type, granularity, partition_id):
+		if partition_id == '__NULL__':
+			return f'{column} IS NULL'
+		start = datetime.strptime(partition_id, self.formats[granularity])
+		if granularity == 'HOUR':
+			end = start + timedelta(hours=1)
+		elif granularity == 'DAY':
+			end = start + timedelta(days=1)
+		elif granularity == 'MONTH':
+			end = start + timedelta(days=calendar.monthrange(start.year, start.month)[1])
+		else:
+			end = start.replace(year=start.year + 1)
+		literal_format = '%Y-%m-%d' if column_type == 'DATE' else '%Y-%m-%d %H:%M:%S'
+		return f"({column} >= {column_type} '{start:{literal_format}}' AND {column} < {column_type} '{end:{literal_format}}')"
@@ -0,0 +1,114 @@
+import json
+import hashlib
+import threading
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+
+class StageCache:
+	'''
+	Records a fingerprint for every pipeline stage that completed, so a rerun can skip stages whose output is still valid.
+	A stage's fingerprint is a hash of its rendered SQL, the last-modified times of the tables it reads and those of the source tables, 
+	so a new source data drop invalidates every stage.
+	A stage is skipped only if its fingerprint matches the recorded one and its output tables were not modified since it ran.
+	Rebuilding a stage changes the modified time of its outputs, which in turn invalidates every stage downstream of it.
+	'''
+	def __init__(self, db, table, verbose=False, sources=()):
+		self.db = db
+		self.table = table
+		self.verbose = verbose
+		self.sources = sorted(sources)
+		self.source_state = None
+		self.records = None
+		self.lock = threading.Lock()
+
+	def get_create_query(self):
+		return f'''
+				CREATE TABLE IF NOT EXISTS `{self.table}` (
+					stage_name STRING,
+					fingerprint STRING,
+					output_state STRING,
+					recorded_at TIMESTAMP
+				)
+				'''
+
+	def get_records(self):
+		'''
+		Returns the latest (fingerprint, output_state) recorded for each stage, reading the metadata table on first use.
+		'''
+		with self.lock:
+			if self.records is None:
+				self.db.execute_sql(self.get_create_query())
+				query = f'''
+						SELECT stage_name, fingerprint, output_state
+						FROM `{self.table}`
+						WHERE TRUE
+						QUALIFY ROW_NUMBER() OVER (PARTITION BY stage_name ORDER BY recorded_at DESC) = 1
+						'''
+				self.records = {
+					row.stage_name: (row.fingerprint, row.output_state)
+					for row in self.db.client.query(query).result()
+				}
+			return self.records
+
+	def get_modified(self, table):
+		try:
+			return self.db.client.get_table(table).modified.isoformat()
+		except NotFound:
+			return None
+
+	def get_source_state(self):
+		'''
+		Returns the modified times of the source tables, read once per run since no stage writes them.
+		'''
+		with self.lock:
+			if self.source_state is None:
+				self.source_state = {table: self.get_modified(table) for table in self.sources}
+			return self.source_state
+
+	def get_fingerprint(self, stage, query):
+		state = {
+			'query': query,
+			'reads': {table: self.get_modified(table) for table in sorted(stage.reads)},
+			'sources': self.get_source_state()
+		}
+		return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+	def get_output_state(self, stage):
+		'''
+		Returns the modified times of the stage's outputs, or None if any of them does not exist.
+		'''
+		modified = {table: self.get_modified(table) for table in sorted(stage.writes)}
+		if None in modified.values():
+			return None
+		return json.dumps(modified, sort_keys=True)
+
+	def is_valid(self, stage, fingerprint):
+		if not stage.writes:
+			return False
+		record = self.get_records().get(stage.name)
+		if record is None or record[0] != fingerprint:
+			return False
+		output_state = self.get_output_state(stage)
+		return output_state is not None and output_state == record[1]
+
+	def record(self, stage, fingerprint):
+		if not stage.writes:
+			return
+		output_state = self.get_output_state(stage)
+		records = self.get_records()
+		query = f'''
+				INSERT INTO `{self.table}` (stage_name, fingerprint, output_state, recorded_at)
+				VALUES (@stage_name, @fingerprint, @output_state, CURRENT_TIMESTAMP())
+				'''
+		job_config = self.get_job_config(stage.name, fingerprint, output_state)
+		# Concurrent DML against the metadata table can conflict, so stages record one at a time
+		with self.lock:
+			self.db.client.query(query, job_config=job_config).result()
+			records[stage.name] = (fingerprint, output_state)
+
+	def get_job_config(self, stage_name, fingerprint, output_state):
+		return bigquery.QueryJobConfig(query_parameters=[
+			bigquery.ScalarQueryParameter('stage_name', 'STRING', stage_name),
+			bigquery.ScalarQueryParameter('fingerprint', 'STRING', fingerprint),
+			bigquery.ScalarQueryParameter('output_state', 'STRING', output_state),
+		])
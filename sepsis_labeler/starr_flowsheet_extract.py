@@ -1,80 +1,255 @@
 from prediction_utils.cohorts.cohort import BQCohort
 from prediction_utils.extraction_utils.database import BQDatabase
+from google.cloud import bigquery
+from sepsis_labeler.scheduler import Stage, DAGScheduler
+from functools import partial
 import os
+import warnings
+from google.api_core.exceptions import NotFound
 
 class STARRFlowsheetExtract(BQCohort):
-	def __init__(self, *args, **kwargs):
+	def __init__(self, *args, db=None, **kwargs):
 		self.config_dict = self.get_config_dict(**kwargs)
-		self.db = BQDatabase(**self.config_dict)
+		self.db = db if db is not None else BQDatabase(**self.config_dict)
 
 	def create_cohort_table(self):
 		"""
 		Extracts the unmapped flowsheet values in the observation table and stores as a table in the database
 		"""
-		self.db.execute_sql(self.get_extract_flowsheets_query())
+		if self.config_dict['incremental_flowsheet']:
+			self.refresh_flowsheets()
+		else:
+			self.db.execute_sql(self.get_extract_flowsheets_query())
+
+	def refresh_flowsheets(self):
+		"""
+		Replaces the monthly partitions of the extract from the month of the last watermark onwards. The first refresh backfills the whole observation history.
+		Slices of flowsheet_slice_months months are extracted into staging tables on max_workers workers, 
+		then swapped into the extract in one transaction that also advances the watermark, 
+		so a failed refresh leaves the extract and watermark as they were and is redone in full by the next one.
+		"""
+		if self.config_dict['targeted_flowsheet_extract']:
+			raise ValueError('Incremental flowsheet extraction requires targeted_flowsheet_extract=False')
+		self.check_partitioning()
+		self.db.execute_sql(self.get_create_partitioned_query())
+		start, end = self.get_refresh_range()
+		if start is None:
+			return
+		slices = self.get_slices(start, end)
+		stages = [
+			Stage(f'flowsheet_slice_{slice_start:%Y%m}', partial(self.get_slice_query, slice_start, slice_end))
+			for slice_start, slice_end in slices
+		]
+		if self.config_dict['print_query']:
+			print(f'Refreshing flowsheets from {start} in {len(stages)} slices...')
+		DAGScheduler(stages, max_workers=self.config_dict['max_workers']).run(lambda stage: self.execute_refresh_query(stage.get_query()))
+		self.execute_refresh_query(self.get_swap_query(slices))
 
-	def get_extract_flowsheets_query(self, *args, **kwargs):
+	def check_partitioning(self):
+		"""
+		Drops an extract that is not partitioned by observation month, e.g. one left by a full extraction, together with its watermark.
+		create table if not exists would otherwise keep it, and every slice would scan the whole table; the refresh backfills it partitioned instead.
+		"""
+		table = '{dataset_project}.{rs_dataset}.{ext_flwsht_table}'.format_map(self.config_dict)
+		try:
+			partitioning = self.db.client.get_table(table).time_partitioning
+		except NotFound:
+			return
+		if partitioning is not None and partitioning.field == 'observation_datetime' and partitioning.type_ == 'MONTH':
+			return
+		warnings.warn(f'{table} is not partitioned by observation month, dropping it to backfill it partitioned')
+		self.db.execute_sql(f'''
+				drop table `{table}`;
+				drop table if exists `{self.config_dict['flowsheet_watermark']}`;
+				''')
+
+	def execute_refresh_query(self, query):
+		"""
+		Runs a query of the refresh capped by the max_bytes_billed of the extract_flowsheets stage, if the labeler set one.
+		"""
+		max_bytes_billed = self.config_dict.get('stage_max_bytes_billed', {}).get('extract_flowsheets', self.config_dict.get('max_bytes_billed'))
+		if not max_bytes_billed:
+			self.db.execute_sql(query)
+			return
+		self.db.client.query(query, job_config=bigquery.QueryJobConfig(maximum_bytes_billed=max_bytes_billed)).result()
+
+	def get_refresh_estimate_queries(self):
+		"""
+		Returns the values queries of the slices a refresh would run, so they can be dry-run.
+		"""
+		start, end = self.get_refresh_range()
+		if start is None:
+			return []
+		return [self.get_values_query(self.get_slice_filter(slice_start, slice_end)) for slice_start, slice_end in self.get_slices(start, end)]
+
+	def get_refresh_range(self):
+		"""
+		Returns the first day of the month of the last watermark, or of the earliest observation if there is none, and the latest observation date.
+		"""
 		query = '''
-				create or replace table {dataset_project}.{rs_dataset}.{ext_flwsht_table} as 
-				(
-					with meas as (
-						select observation_id, 
-						json_extract_scalar(v, '$.source') as val_source,
-						json_extract_scalar(v, '$.value') as val_value
-
-						FROM `{dataset_project}.{dataset}.observation` ob 
-						left join unnest(json_extract_array(value_as_string,'$.values')) as v
-						where ob.observation_concept_id = 2000006253
-						and JSON_VALUE(v,'$.source') = "ip_flwsht_meas.meas_value"
-					),
+				select 
+					coalesce(
+						date_trunc(date((select max(watermark) from `{flowsheet_watermark}`)), month),
+						date_trunc(date(min(observation_datetime)), month)
+					) as start_date,
+					date(max(observation_datetime)) as end_date
+				from `{dataset_project}.{dataset}.observation`
+				'''.format_map(self.config_dict)
+		row = list(self.db.client.query(query).result())[0]
+		return row.start_date, row.end_date
 
-					disp as (
-						select observation_id, 
-						json_extract_scalar(v, '$.source') as val_source,
-						json_extract_scalar(v, '$.value') as val_value
+	def get_slices(self, start, end):
+		"""
+		Returns [start, end) date slices of flowsheet_slice_months months covering start to end.
+		"""
+		slices = []
+		while start <= end:
+			month = start.month - 1 + self.config_dict['flowsheet_slice_months']
+			slice_end = start.replace(year=start.year + month // 12, month=month % 12 + 1, day=1)
+			slices.append((start, slice_end))
+			start = slice_end
+		return slices
 
-						FROM `{dataset_project}.{dataset}.observation` ob 
-						left join unnest(json_extract_array(value_as_string,'$.values')) as v
-						where ob.observation_concept_id = 2000006253
-						and JSON_VALUE(v,'$.source') = "ip_flo_gp_data.disp_name"
-					),
+	def get_create_partitioned_query(self):
+		query = '''
+				create table if not exists `{dataset_project}.{rs_dataset}.{ext_flwsht_table}` (
+					observation_id INT64,
+					person_id INT64,
+					visit_occurrence_id INT64,
+					observation_datetime DATETIME,
+					source_display_name STRING,
+					display_name STRING,
+					meas_value STRING,
+					units STRING
+				)
+				{table_options_str};
+				create table if not exists `{flowsheet_watermark}` (
+					watermark DATETIME,
+					recorded_at TIMESTAMP
+				);
+				'''
+		return query.format_map(self.config_dict)
 
-					unit as (
-						select observation_id, 
-						json_extract_scalar(v, '$.source') as val_source,
-						json_extract_scalar(v, '$.value') as val_value
+	def get_slice_filter(self, start, end):
+		return f"ob.observation_datetime >= DATETIME '{start}' and ob.observation_datetime < DATETIME '{end}'"
 
-						FROM `{dataset_project}.{dataset}.observation` ob 
-						left join unnest(json_extract_array(value_as_string,'$.values')) as v
-						where ob.observation_concept_id = 2000006253
-						and JSON_VALUE(v,'$.source') = "ip_flo_gp_data.units"
-					),
+	def get_staging_table(self, start):
+		return '{dataset_project}.{rs_dataset}.{ext_flwsht_table}_slice_{start:%Y%m}'.format(start=start, **self.config_dict)
 
-					src as (
-						select observation_id, 
-						json_extract_scalar(v, '$.source') as val_source,
-						json_extract_scalar(v, '$.value') as val_value
+	def get_slice_query(self, start, end):
+		"""
+		Extracts a slice into its staging table. Staging tables expire on their own if a refresh fails before swapping them in.
+		"""
+		query = '''
+				create or replace table `{staging_table}` 
+				options (expiration_timestamp = timestamp_add(current_timestamp(), interval 1 day)) as
+				{values_query}
+				'''
+		return query.format_map({
+			**self.config_dict, 
+			"staging_table":self.get_staging_table(start), 
+			"values_query":self.get_values_query(self.get_slice_filter(start, end))
+		})
 
-						FROM `{dataset_project}.{dataset}.observation` ob 
-						left join unnest(json_extract_array(observation_source_value,'$.values')) as v
-						where ob.observation_concept_id = 2000006253
-						and JSON_VALUE(v,'$.source') = "ip_flt_data.display_name"
+	def get_swap_query(self, slices):
+		"""
+		Replaces the months of every slice with its staging table and records the watermark in one transaction, then drops the staging tables.
+		"""
+		swaps = ''.join(
+			'''
+				delete from `{dataset_project}.{rs_dataset}.{ext_flwsht_table}` 
+				where observation_datetime >= DATETIME '{start}' and observation_datetime < DATETIME '{end}';
+				insert into `{dataset_project}.{rs_dataset}.{ext_flwsht_table}` 
+					(observation_id, person_id, visit_occurrence_id, observation_datetime, source_display_name, display_name, meas_value, units)
+				select observation_id, person_id, visit_occurrence_id, observation_datetime, source_display_name, display_name, meas_value, units
+				from `{staging_table}`;'''.format(start=start, end=end, staging_table=self.get_staging_table(start), **self.config_dict)
+			for start, end in slices
+		)
+		drops = ''.join(f'''
+				drop table if exists `{self.get_staging_table(start)}`;''' for start, _ in slices)
+		return 'begin transaction;' + swaps + self.get_record_watermark_query() + ';\ncommit transaction;' + drops
+
+	def get_record_watermark_query(self):
+		query = '''
+				insert into `{flowsheet_watermark}` (watermark, recorded_at)
+				select max(observation_datetime), current_timestamp()
+				from `{dataset_project}.{rs_dataset}.{ext_flwsht_table}`
+				'''
+		return query.format_map(self.config_dict)
+
+	def get_input_tables(self):
+		return [self.config_dict['admission_rollup']] if self.config_dict['targeted_flowsheet_extract'] else []
+
+	def get_output_tables(self):
+		return ['{dataset_project}.{rs_dataset}.{ext_flwsht_table}'.format_map(self.config_dict)]
+
+	def get_extract_flowsheets_query(self, format_query=True):
+		query = '''
+				create or replace table {dataset_project}.{rs_dataset}.{ext_flwsht_table} {table_options_str} as 
+				(
+					{values_query}
+				)
+		'''
+		if not format_query:
+			return query
+		else:
+			return query.format_map({**self.config_dict, "values_query":self.get_values_query()})
+
+	def get_values_query(self, slice_filter=None):
+		query = '''
+					-- Flowsheet rows keep their fields in a JSON values array; pivot it once per row
+					with ob_values as (
+						select ob.*,
+						if(ob.observation_concept_id = 2000006253,
+							(
+								select as struct 
+								max(if(json_extract_scalar(v, '$.source') = "ip_flwsht_meas.meas_value", json_extract_scalar(v, '$.value'), null)) as meas_value,
+								max(if(json_extract_scalar(v, '$.source') = "ip_flo_gp_data.disp_name", json_extract_scalar(v, '$.value'), null)) as disp_name,
+								max(if(json_extract_scalar(v, '$.source') = "ip_flo_gp_data.units", json_extract_scalar(v, '$.value'), null)) as units
+								from unnest(json_extract_array(ob.value_as_string,'$.values')) as v
+							),
+							null
+						) as vals,
+						if(ob.observation_concept_id = 2000006253,
+							(
+								select max(json_extract_scalar(v, '$.value'))
+								from unnest(json_extract_array(ob.observation_source_value,'$.values')) as v
+								where json_extract_scalar(v, '$.source') = "ip_flt_data.display_name"
+							),
+							null
+						) as src_display_name
+						from `{dataset_project}.{dataset}.observation` ob 
+						{observation_filter_str}
+					),
+					-- One row per visit and calendar day it spans, so observations are matched to visits on the same day only
+					visit_days as (
+						select person_id, visit_occurrence_id, visit_start_DATETIME, visit_end_DATETIME, visit_day
+						from `{dataset_project}.{dataset}.visit_occurrence`
+						cross join unnest(generate_date_array(date(visit_start_DATETIME), date(visit_end_DATETIME))) as visit_day
+						{visit_filter_str}
+					),
+					-- Visits longer than flowsheet_visit_max_days are matched on their range instead of expanded into days
+					long_visits as (
+						select person_id, visit_occurrence_id, visit_start_DATETIME, visit_end_DATETIME
+						from `{dataset_project}.{dataset}.visit_occurrence`
+						{long_visit_filter_str}
 					)
+					{admission_days_cte}
 
-					select ob.observation_id, ob.person_id, vo.visit_occurrence_id, ob.observation_datetime,
+					select ob.observation_id, ob.person_id, coalesce(vo.visit_occurrence_id, lv.visit_occurrence_id) as visit_occurrence_id, ob.observation_datetime,
 					case 
 						when ob.observation_concept_id = 2000006253
-							then src.val_value 
+							then ob.src_display_name 
 						else ob.observation_source_value
 					END as source_display_name,
 					case 
 						when ob.observation_concept_id = 2000006253
-							then disp.val_value
+							then ob.vals.disp_name
 						else cpt.concept_name
 					END as display_name,
 					case 
 						when ob.observation_concept_id = 2000006253
-							then meas.val_value
+							then ob.vals.meas_value
 						when ob.observation_concept_id <> 2000006253 and value_as_string is not null
 							then value_as_string
 						when ob.observation_concept_id <> 2000006253 and value_as_string is null
@@ -82,23 +257,51 @@ class STARRFlowsheetExtract(BQCohort):
 					END as meas_value,
 					case 
 						when ob.observation_concept_id = 2000006253
-							then unit.val_value
+							then ob.vals.units
 						else ob.unit_source_value
 					END as units,
-					from {dataset_project}.{dataset}.observation` ob 
-					left join meas on ob.observation_id = meas.observation_id
-					left join unit on ob.observation_id = unit.observation_id 
-					left join disp on ob.observation_id = disp.observation_id
-					left join src on ob.observation_id = src.observation_id
+					from ob_values ob 
 					left join `{dataset_project}.{dataset}.concept` cpt on cpt.concept_id = ob.observation_source_concept_id
-					left join `{dataset_project}.{dataset}.visit_occurrence` vo on ob.person_id = vo.person_id 
+					left join visit_days vo on ob.person_id = vo.person_id and date(ob.observation_datetime) = vo.visit_day
 					and ob.observation_datetime >= vo.visit_start_DATETIME and ob.observation_datetime <= vo.visit_end_DATETIME
-				)
+					-- Only observations outside every expanded visit look for a long one
+					left join long_visits lv on vo.person_id is null and ob.person_id = lv.person_id
+					and ob.observation_datetime >= lv.visit_start_DATETIME and ob.observation_datetime <= lv.visit_end_DATETIME
+					{admission_days_join_str}
+					{target_where_str}
 		'''
-		if not format_query:
-			return query
-		else:
-			return query.format_map(self.config_dict)
+		target_strs = self.get_target_strs()
+		observation_filters = [target_strs.pop('cohort_filter')] if self.config_dict['targeted_flowsheet_extract'] else []
+		if slice_filter is not None:
+			observation_filters.append(slice_filter)
+		observation_filter_str = 'where ' + ' and '.join(observation_filters) if observation_filters else ''
+		return query.format_map({**self.config_dict, **target_strs, "observation_filter_str":observation_filter_str})
+
+	def get_target_strs(self):
+		'''
+		Returns the clauses restricting a targeted extract to the rows of cohort persons that the components read:
+		rows whose display name matches flowsheet_display_names, and with flowsheet_admission_days, every row on an admission day.
+		'''
+		if not self.config_dict['targeted_flowsheet_extract']:
+			return {"admission_days_cte":"", "admission_days_join_str":"", "target_where_str":""}
+		display_name = "upper(case when ob.observation_concept_id = 2000006253 then ob.vals.disp_name else cpt.concept_name end)"
+		filters = [f"{display_name} like '{name}'" for name in self.config_dict['flowsheet_display_names']]
+		strs = {
+			"cohort_filter":"ob.person_id in (select person_id from `{admission_rollup}`)".format_map(self.config_dict),
+			"admission_days_cte":"",
+			"admission_days_join_str":"",
+		}
+		if self.config_dict['flowsheet_admission_days']:
+			strs["admission_days_cte"] = '''
+					, admission_days as (
+						select distinct person_id, cast(admit_date as date) as admit_day
+						from `{admission_rollup}`
+					)'''.format_map(self.config_dict)
+			strs["admission_days_join_str"] = '''left join admission_days on ob.person_id = admission_days.person_id 
+					and cast(ob.observation_datetime as date) = admission_days.admit_day'''
+			filters.append("admission_days.person_id is not null")
+		strs["target_where_str"] = "where " + ("\n\t\t\t\t\tor ".join(filters) if filters else "false")
+		return strs
 
 	def get_defaults(self):
 		return {
@@ -115,6 +318,16 @@ class STARRFlowsheetExtract(BQCohort):
 			"limit": None,
 			"min_stay_hour":0,
 			"print_query":False,
+			"partition_tables":False,
+			"targeted_flowsheet_extract":False,
+			"flowsheet_display_names":[],
+			"flowsheet_admission_days":False,
+			"admission_rollup":None,
+			"flowsheet_visit_concept_ids":[9201, 262],
+			"flowsheet_visit_max_days":30,
+			"incremental_flowsheet":False,
+			"flowsheet_slice_months":12,
+			"max_workers":8,
 		}
 
 	def override_defaults(self, **kwargs):
@@ -159,4 +372,28 @@ class STARRFlowsheetExtract(BQCohort):
 			)
 			else config_dict["gcloud_project"]
 		)
+		config_dict["admission_rollup"] = (
+			config_dict["admission_rollup"]
+			if config_dict["admission_rollup"] is not None
+			else "{rs_dataset_project}.{rs_dataset}.sepsis_admission_rollup".format_map(config_dict)
+		)
+		visit_filters = (
+			["visit_concept_id in ({})".format(", ".join(str(concept_id) for concept_id in config_dict["flowsheet_visit_concept_ids"]))]
+			if config_dict["flowsheet_visit_concept_ids"]
+			else []
+		)
+		visit_length = "date_diff(date(visit_end_DATETIME), date(visit_start_DATETIME), day) + 1"
+		max_days = config_dict["flowsheet_visit_max_days"]
+		day_visit_filters = visit_filters + ([f"{visit_length} <= {max_days}"] if max_days is not None else [])
+		config_dict["visit_filter_str"] = "where " + " and ".join(day_visit_filters) if day_visit_filters else ""
+		config_dict["long_visit_filter_str"] = (
+			"where " + " and ".join(visit_filters + [f"{visit_length} > {max_days}"])
+			if max_days is not None
+			else "where false"
+		)
+		config_dict["flowsheet_watermark"] = "{dataset_project}.{rs_dataset}.{ext_flwsht_table}_watermark".format_map(config_dict)
+		config_dict["table_options_str"] = " ".join(
+			(["PARTITION BY DATETIME_TRUNC(observation_datetime, MONTH)"] if config_dict["incremental_flowsheet"] else [])
+			+ (["CLUSTER BY display_name, person_id"] if config_dict["partition_tables"] or config_dict["incremental_flowsheet"] else [])
+		)
 		return config_dict
\ No newline at end of file